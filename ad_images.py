@@ -1,21 +1,480 @@
+import os
+import re
+import json
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict, deque, namedtuple
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.remote.command import Command
 from time import sleep
 from six import BytesIO
-import base64
+from six.moves.urllib.parse import urljoin
+import binascii
 from PIL import Image
-from adblockparser import AdblockRules
+from adblockparser import AdblockRule
+from crawler_utils import open_tab, switch_to_tab
 
 USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/77.0.3865.75 Safari/537.36'
 
+EASYLIST_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'easylist.txt'
+)
+EASYLIST_CACHE_SUFFIX = '.cache'
+# Bump whenever the pickled layout of `AdMatcher` changes.
+AD_MATCHER_CACHE_VERSION = 2
+
+URL_VERDICT_CACHE_SIZE = 1 << 16
+
+# Page readiness: a page is ready once at most PAGE_READY_MAX_IN_FLIGHT
+# requests are pending and neither the network nor the iframe layout has
+# changed for PAGE_READY_QUIET_PERIOD seconds, or after the max wait.
+PAGE_READY_MAX_WAIT = 20
+RESIZE_READY_MAX_WAIT = 5
+PAGE_READY_QUIET_PERIOD = 1.0
+PAGE_READY_POLL_INTERVAL = 0.25
+PAGE_READY_MAX_IN_FLIGHT = 2
+
+# Network capture: resource types whose bodies are kept as creatives, and
+# the smallest image side that is not a tracking pixel. Media bodies are
+# usually range requests that cannot be signed, so only images by default.
+CREATIVE_RESOURCE_TYPES = ('Image',)
+MIN_CREATIVE_SIDE = 10
+
+# Pages loading in background tabs while the current one is analyzed.
+PIPELINE_DEPTH = 1
+
+_ad_matchers = {}
+_ad_matcher_lock = threading.Lock()
+
+
+def _file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# Runs of these characters are the unit of the token index; everything else
+# (including what the `^` separator matches) splits tokens.
+_TOKEN_RE = re.compile(r'[a-z0-9%]+')
+_HOST_RE = re.compile(r'[a-z0-9.\-]+')
+_NON_HOST_RE = re.compile(r'[^a-z0-9.\-]+')
+_AUTHORITY_RE = re.compile(r'^(?:[^:/?#]+:)?//([^/?#]*)')
+_SCHEME_RE = re.compile(r'^[^:/?#]+:')
+# Tokens present in nearly every URL make poor index keys.
+_COMMON_URL_TOKENS = frozenset(
+    ['http', 'https', 'www', 'com', 'net', 'org', 'html', 'js', 'php']
+)
+
+
+def _rule_domain(rule_text):
+    """ Returns `domain` for `||domain^`-style rules that pin a full host
+    suffix, else None """
+    if not rule_text.startswith('||'):
+        return None
+    host = _HOST_RE.match(rule_text, 2)
+    if not host:
+        return None
+    rest = rule_text[host.end():]
+    if not rest or rest[0] == '*':
+        return None
+    return host.group()
+
+
+def _rule_tokens(rule_text):
+    """ Returns the tokens that any URL matched by the rule must contain as
+    whole tokens """
+    start_anchored = rule_text.startswith('|')
+    end_anchored = rule_text.endswith('|')
+    body = rule_text.lstrip('|')
+    if end_anchored:
+        body = body[:-1]
+
+    tokens = []
+    for match in _TOKEN_RE.finditer(body):
+        start, end = match.span()
+        if start == 0:
+            left_bounded = start_anchored
+        else:
+            left_bounded = body[start - 1] != '*'
+        if end == len(body):
+            right_bounded = end_anchored
+        else:
+            right_bounded = body[end] != '*'
+        if left_bounded and right_bounded:
+            tokens.append(match.group())
+    return tokens
+
+
+def _url_domains(lowered_url):
+    """ Returns every host suffix a `||domain^` rule could match in the URL """
+    domains = set()
+    authority = _AUTHORITY_RE.match(lowered_url)
+    if authority:
+        for piece in _NON_HOST_RE.split(authority.group(1)):
+            domains.add(piece)
+            for i, char in enumerate(piece):
+                if char == '.':
+                    domains.add(piece[i + 1:])
+
+    # `||` rules also match scheme-relative oddities like `about:ads.com`.
+    host = _HOST_RE.match(lowered_url)
+    if host:
+        domains.add(host.group())
+    scheme = _SCHEME_RE.match(lowered_url)
+    if scheme:
+        host = _HOST_RE.match(lowered_url, scheme.end())
+        if host:
+            domains.add(host.group())
+    return domains
+
+
+class _RuleIndex(object):
+    """
+    One side (blacklist or whitelist) of `TokenIndexedRules`. Rules are kept
+    as regex sources and compiled on first use.
+    """
+
+    def __init__(self):
+        self.regexes = []
+        self.flags = []
+        self.by_domain = {}
+        self.by_token = {}
+        self.fallback = []
+        self.fallback_case_sensitive = []
+        self._compiled = None
+        self._fallback_re = None
+
+    def add(self, rule, token_counts):
+        rule_id = len(self.regexes)
+        case_sensitive = 'match-case' in rule.options
+        self.regexes.append(rule.regex)
+        self.flags.append(0 if case_sensitive else re.IGNORECASE)
+
+        rule_text = rule.rule_text.lower()
+        is_regex_rule = rule_text.startswith('/') and rule_text.endswith('/')
+        # adblockparser mangles `|` inside a rule, so its regex cannot be
+        # reasoned about from the text.
+        has_inner_bar = '|' in rule_text.strip('|')
+        if rule.regex and not is_regex_rule and not has_inner_bar:
+            domain = _rule_domain(rule_text)
+            if domain:
+                self.by_domain.setdefault(domain, []).append(rule_id)
+                return
+
+            tokens = _rule_tokens(rule_text)
+            if tokens:
+                token = min(tokens, key=lambda token: (
+                    token in _COMMON_URL_TOKENS,
+                    token_counts[token],
+                    -len(token)
+                ))
+                self.by_token.setdefault(token, []).append(rule_id)
+                return
+
+        if case_sensitive or not rule.regex:
+            self.fallback_case_sensitive.append(rule_id)
+        else:
+            self.fallback.append(rule_id)
+
+    def _search(self, rule_id, url):
+        compiled = self._compiled[rule_id]
+        if compiled is None:
+            compiled = re.compile(self.regexes[rule_id], self.flags[rule_id])
+            self._compiled[rule_id] = compiled
+        return compiled.search(url)
+
+    def matches(self, url, tokens, domains):
+        if self._compiled is None:
+            self._compiled = [None] * len(self.regexes)
+            fallback = '|'.join(self.regexes[i] for i in self.fallback)
+            if fallback:
+                self._fallback_re = re.compile(fallback, re.IGNORECASE)
+
+        for domain in domains:
+            for rule_id in self.by_domain.get(domain, ()):
+                if self._search(rule_id, url):
+                    return True
+        for token in tokens:
+            for rule_id in self.by_token.get(token, ()):
+                if self._search(rule_id, url):
+                    return True
+
+        if self._fallback_re is not None and self._fallback_re.search(url):
+            return True
+        return any(
+            self._search(rule_id, url)
+            for rule_id in self.fallback_case_sensitive
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_compiled'] = None
+        state['_fallback_re'] = None
+        return state
+
+
+class TokenIndexedRules(object):
+    """
+    Drop-in replacement for `AdblockRules.should_block(url)` without options.
+
+    Each rule is filed under the host of a `||domain^` anchor or under its
+    rarest token that must appear whole in any matching URL, so a URL is
+    only tested against the rules filed under its own hosts and tokens (plus
+    a small remainder of rules with no usable token).
+    """
+
+    def __init__(self, rules):
+        rules = list(rules)
+        token_counts = {}
+        for rule in rules:
+            for token in set(_rule_tokens(rule.rule_text.lower())):
+                token_counts[token] = token_counts.get(token, 0) + 1
+
+        self.blacklist = _RuleIndex()
+        self.whitelist = _RuleIndex()
+        for rule in rules:
+            if rule.is_exception:
+                self.whitelist.add(rule, token_counts)
+            else:
+                self.blacklist.add(rule, token_counts)
+
+    def should_block(self, url):
+        lowered_url = url.lower()
+        tokens = set(_TOKEN_RE.findall(lowered_url))
+        domains = _url_domains(lowered_url)
+        if self.whitelist.matches(url, tokens, domains):
+            return False
+        return self.blacklist.matches(url, tokens, domains)
+
+
+class AdMatcher(object):
+    """
+    EasyList matcher for bare URL checks (no request options).
+
+    Only the rules that can fire when `should_block` is called without
+    options are kept, and they are indexed by `TokenIndexedRules`. Regexes
+    are compiled lazily and are never pickled, so the cached matcher loads
+    without re-parsing the list.
+    """
+
+    def __init__(self, raw_rules, list_mtime=None, list_digest=None):
+        self.version = AD_MATCHER_CACHE_VERSION
+        self.raw_rules = []
+        url_rules = []
+        for raw_rule in raw_rules:
+            rule = AdblockRule(raw_rule)
+            if (rule.regex or rule.options) and rule.matching_supported({}):
+                self.raw_rules.append(raw_rule)
+                url_rules.append(rule)
+        self.rules = TokenIndexedRules(url_rules)
+        self.list_mtime = list_mtime
+        self.list_digest = list_digest
+
+    @classmethod
+    def from_file(cls, list_path):
+        with open(list_path, 'r') as file:
+            raw_rules = file.readlines()
+        return cls(
+            raw_rules,
+            list_mtime=os.stat(list_path).st_mtime_ns,
+            list_digest=_file_digest(list_path)
+        )
+
+    def should_block(self, url):
+        return self.rules.should_block(url)
+
+
+def _load_ad_matcher_cache(cache_path):
+    try:
+        with open(cache_path, 'rb') as file:
+            matcher = pickle.load(file)
+    except Exception:
+        # Missing, truncated, or pickled by another version of these
+        # classes (ImportError, TypeError, ValueError...): rebuild it.
+        return None
+    if getattr(matcher, 'version', None) != AD_MATCHER_CACHE_VERSION:
+        return None
+    return matcher
+
+
+def _save_ad_matcher_cache(matcher, cache_path):
+    tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(matcher, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print('Exception writing ad matcher cache:', e)
+
+
+def _refresh_ad_matcher(list_path, list_mtime):
+    cache_path = list_path + EASYLIST_CACHE_SUFFIX
+    candidates = [
+        _ad_matchers.get(list_path), _load_ad_matcher_cache(cache_path)
+    ]
+    list_digest = None
+    for matcher in candidates:
+        if matcher is None:
+            continue
+        if matcher.list_mtime == list_mtime:
+            return matcher
+        # Touched but maybe not changed: fall back to the content hash.
+        if list_digest is None:
+            list_digest = _file_digest(list_path)
+        if matcher.list_digest == list_digest:
+            matcher.list_mtime = list_mtime
+            _save_ad_matcher_cache(matcher, cache_path)
+            return matcher
+
+    matcher = AdMatcher.from_file(list_path)
+    _save_ad_matcher_cache(matcher, cache_path)
+    return matcher
+
+
+def get_ad_matcher(list_path=EASYLIST_PATH):
+    """
+    Returns the process-wide `AdMatcher` for `list_path`, building it at most
+    once and reloading it only when the list's mtime and hash change. A
+    pickled copy is kept next to the list so new processes skip the parse.
+    """
+    list_mtime = os.stat(list_path).st_mtime_ns
+    matcher = _ad_matchers.get(list_path)
+    if matcher is not None and matcher.list_mtime == list_mtime:
+        return matcher
+
+    with _ad_matcher_lock:
+        matcher = _refresh_ad_matcher(list_path, list_mtime)
+        _ad_matchers[list_path] = matcher
+        return matcher
+
+
+def normalize_url(url):
+    """ Strips surrounding whitespace and lowercases the scheme and host,
+    which never changes an EasyList verdict """
+    url = url.strip()
+    authority = _AUTHORITY_RE.match(url)
+    if not authority:
+        return url
+    return url[:authority.end()].lower() + url[authority.end():]
+
+
+UrlVerdictCacheInfo = namedtuple(
+    'UrlVerdictCacheInfo', ['hits', 'misses', 'maxsize', 'currsize']
+)
+
+
+class UrlVerdictCache(object):
+    """
+    Bounded LRU of `check_if_ad` verdicts keyed on the normalized URL.
+
+    Ad-server URLs repeat across sites and accounts, so one cache is shared
+    by the whole process; `info()` reports hits and misses like
+    `functools.lru_cache`.
+    """
+
+    def __init__(self, maxsize=URL_VERDICT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._verdicts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def classify(self, urls, should_block):
+        """ Returns `{url: verdict}` for the de-duplicated `urls`, calling
+        `should_block` only for URLs not already cached """
+        verdicts = {}
+        misses = []
+        with self._lock:
+            for url in urls:
+                if not url or url in verdicts:
+                    continue
+                key = normalize_url(url)
+                verdict = self._verdicts.get(key)
+                if verdict is None:
+                    verdicts[url] = None
+                    misses.append((url, key))
+                    continue
+                self._verdicts.move_to_end(key)
+                verdicts[url] = verdict
+                self.hits += 1
+
+        if not misses:
+            return verdicts
+
+        fresh = [(url, key, should_block(key)) for url, key in misses]
+        with self._lock:
+            for url, key, verdict in fresh:
+                verdicts[url] = verdict
+                self._verdicts[key] = verdict
+                self._verdicts.move_to_end(key)
+                self.misses += 1
+            while len(self._verdicts) > self.maxsize:
+                self._verdicts.popitem(last=False)
+        return verdicts
+
+    def info(self):
+        with self._lock:
+            return UrlVerdictCacheInfo(
+                self.hits, self.misses, self.maxsize, len(self._verdicts)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._verdicts.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+url_verdict_cache = UrlVerdictCache()
+
+
+def classify_urls(urls):
+    """
+    Returns `{url: is_ad}` for every distinct non-empty URL in `urls`, using
+    the shared `url_verdict_cache` and the process-wide EasyList matcher.
+    """
+    return url_verdict_cache.classify(urls, get_ad_matcher().should_block)
+
 
 def check_if_ad(url):
-    with open('easylist.txt', 'r') as file:
-        raw_rules = file.readlines()
-    rules = AdblockRules(raw_rules)
-    return rules.should_block(url)
+    return classify_urls([url]).get(url, False)
+
+# Collects every `src`/`href` in the current frame in one WebDriver call.
+# Properties are preferred over attributes so URLs come back resolved, as
+# `WebElement.get_attribute` returns them.
+HARVEST_LINKS_SCRIPT = """
+var links = [];
+var elements = document.getElementsByTagName('*');
+for (var i = 0; i < elements.length; i++) {
+    var element = elements[i];
+    for (var j = 0; j < 2; j++) {
+        var name = j ? 'href' : 'src';
+        var link = typeof element[name] === 'string' ?
+            element[name] : element.getAttribute(name);
+        if (link) links.push(link);
+    }
+}
+return links;
+"""
+
+
+def get_iframe_links(driver, use_script=True):
+    """
+    Returns every `src` and `href` in the frame `driver` is switched to.
+    With `use_script` the frame is harvested by `HARVEST_LINKS_SCRIPT` in a
+    single round trip instead of two `get_attribute` calls per element.
+    """
+    if use_script:
+        try:
+            return driver.execute_script(HARVEST_LINKS_SCRIPT) or []
+        except Exception as e:
+            print('Exception harvesting links, falling back:', e)
 
-def check_if_iframe_is_ad(driver):
     all_links = []
     all_elements = driver.find_elements_by_xpath(".//*")
     for element in all_elements:
@@ -30,74 +489,683 @@ def check_if_iframe_is_ad(driver):
             if link: all_links.append(link)
         except:
             pass
-    for link in all_links:
-        if link and check_if_ad(link):
-            return True
-    return False
+    return all_links
 
 
-def get_ad_images_from_url(driver, url, debug=False):
+def check_if_iframe_is_ad(driver, use_script=True):
+    all_links = get_iframe_links(driver, use_script=use_script)
+    return any(classify_urls(all_links).values())
+
+
+def find_ads_by_switching_frames(driver):
+    """ Returns `(location, size)` of every top-level iframe whose links are
+    ads, switching into each iframe in turn """
+    ads = []
+    all_iframes = driver.find_elements_by_tag_name("iframe")
+    for iframe in all_iframes:
+        try:
+            iframe_location = iframe.location
+            iframe_size = iframe.size
+            driver.switch_to.frame(iframe)
+            is_ad = check_if_iframe_is_ad(driver)
+            if is_ad:
+                ads.append((iframe_location, iframe_size))
+
+        except Exception as e:
+            print("Exception getting iframe:", e)
+
+        finally:
+            driver.switch_to.default_content()
+    return ads
+
+
+def capture_dom_snapshot(driver):
+    """ Returns a `DOMSnapshot.captureSnapshot` of the page, which includes
+    the documents of cross-origin frames and the layout rect of each node """
+    return driver.execute_cdp_cmd(
+        'DOMSnapshot.captureSnapshot', {'computedStyles': []}
+    )
+
+
+def _snapshot_document_links(document, strings):
+    """ Returns the resolved `src`/`href` values of every node in one
+    snapshot document """
+    base_url = strings[document['baseURL']]
+    links = []
+    for attributes in document['nodes'].get('attributes', ()):
+        for i in range(0, len(attributes), 2):
+            if strings[attributes[i]].lower() in ('src', 'href'):
+                link = strings[attributes[i + 1]].strip()
+                if link:
+                    links.append(urljoin(base_url, link))
+    return links
+
+
+def find_ads_in_dom_snapshot(snapshot):
+    """
+    Offline equivalent of `find_ads_by_switching_frames` over the result of
+    `capture_dom_snapshot`: every iframe of the main document whose frame
+    document links to an ad is returned as `(location, size)`.
+    """
+    strings = snapshot['strings']
+    documents = snapshot['documents']
+    if not documents:
+        return []
+
+    main_document = documents[0]
+    nodes = main_document['nodes']
+    content_documents = dict(zip(
+        nodes.get('contentDocumentIndex', {}).get('index', ()),
+        nodes.get('contentDocumentIndex', {}).get('value', ())
+    ))
+    layout = main_document['layout']
+    bounds = dict(zip(layout['nodeIndex'], layout['bounds']))
+
     ads = []
+    for node_index, name_index in enumerate(nodes['nodeName']):
+        if strings[name_index].upper() != 'IFRAME':
+            continue
+        # Frames without a layout box crop to nothing in the screenshot.
+        if node_index not in bounds or node_index not in content_documents:
+            continue
+
+        document = documents[content_documents[node_index]]
+        links = _snapshot_document_links(document, strings)
+        if any(classify_urls(links).values()):
+            x, y, width, height = bounds[node_index]
+            ads.append((
+                {'x': round(x), 'y': round(y)},
+                {'width': width, 'height': height}
+            ))
+    return ads
+
+
+def find_ads_by_dom_snapshot(driver):
+    """ Returns the same `(location, size)` tuples as
+    `find_ads_by_switching_frames` from a single DevTools snapshot """
+    return find_ads_in_dom_snapshot(capture_dom_snapshot(driver))
+
+
+AD_FINDERS = {
+    'frames': find_ads_by_switching_frames,
+    'snapshot': find_ads_by_dom_snapshot,
+}
+
+
+# `readyState` plus the rect of every iframe, so late ad auctions that add
+# or resize frames keep the page from looking settled.
+LAYOUT_SIGNATURE_SCRIPT = """
+var signature = [document.readyState];
+var iframes = document.getElementsByTagName('iframe');
+for (var i = 0; i < iframes.length; i++) {
+    var rect = iframes[i].getBoundingClientRect();
+    signature.push([rect.left, rect.top, rect.width, rect.height].join(','));
+}
+return signature.join(';');
+"""
+
+PageReadiness = namedtuple(
+    'PageReadiness', ['elapsed', 'timed_out', 'in_flight', 'iframes']
+)
+
+# url -> list of `PageReadiness` for every visit in this process
+time_to_ready = {}
+
+
+def drain_performance_log(driver):
+    """ Discards buffered performance log entries, e.g. before navigating,
+    so requests of the previous page are not counted as in flight """
+    try:
+        driver.get_log('performance')
+    except Exception:
+        pass
+
+
+class NetworkActivity(object):
+    """
+    Follows in-flight requests through the Chrome performance log
+    (`goog:loggingPrefs` must enable 'performance'). If the log is not
+    available, `available` turns False and only layout stability counts.
+
+    Responses of a resource type in `collect_types` are kept in `responses`
+    (requestId -> url, document URL, type, finished) for
+    `capture_creatives_from_network`. `bytes_received` adds up the encoded
+    size of finished requests and `blocked` lists the URLs that DevTools
+    blocked (see `resource_blocking`). With a `router`, the log is read by
+    the router, which hands this object only its own tab's events.
+    """
+
+    def __init__(self, collect_types=(), router=None):
+        self.in_flight = set()
+        self.last_event = None
+        self.available = True
+        self.collect_types = frozenset(collect_types)
+        self.document_urls = {}
+        self.responses = OrderedDict()
+        self.router = router
+        self.request_urls = {}
+        self.bytes_received = 0
+        self.blocked = []
+
+    def poll(self, driver):
+        if self.router is not None:
+            self.router.poll(driver)
+            self.available = self.router.available
+            return
+        if not self.available:
+            return
+        try:
+            entries = driver.get_log('performance')
+        except Exception:
+            self.available = False
+            return
+
+        for entry in entries:
+            self.handle(json.loads(entry['message'])['message'])
+
+    def handle(self, message):
+        method = message.get('method')
+        params = message.get('params', {})
+        if method == 'Network.requestWillBeSent':
+            self.in_flight.add(params['requestId'])
+            self.request_urls[params['requestId']] = params['request']['url']
+            if self.collect_types:
+                self.document_urls[params['requestId']] = params.get(
+                    'documentURL'
+                )
+        elif method in ('Network.loadingFinished', 'Network.loadingFailed'):
+            self.in_flight.discard(params['requestId'])
+            if method == 'Network.loadingFinished':
+                self.bytes_received += params.get('encodedDataLength', 0)
+            elif params.get('blockedReason'):
+                self.blocked.append(
+                    self.request_urls.get(params['requestId'])
+                )
+            response = self.responses.get(params['requestId'])
+            if response is not None:
+                response['finished'] = method == 'Network.loadingFinished'
+        elif method == 'Network.responseReceived':
+            if params.get('type') in self.collect_types:
+                self.responses[params['requestId']] = {
+                    'url': params['response']['url'],
+                    'document_url': self.document_urls.get(
+                        params['requestId']
+                    ),
+                    'type': params['type'],
+                    'finished': False
+                }
+            return
+        else:
+            return
+        self.last_event = time.monotonic()
+
+
+def _window_webview(handle):
+    # ChromeDriver window handles are the DevTools target ID, optionally
+    # prefixed; performance log entries name their target as `webview`.
+    if handle.startswith('CDwindow-'):
+        return handle[len('CDwindow-'):]
+    return handle
+
+
+class PerformanceLogRouter(object):
+    """
+    Reads the performance log, which is shared by every tab of a session,
+    and feeds each entry to the `NetworkActivity` of the tab it came from.
+    Entries of tabs without one are dropped.
+    """
+
+    def __init__(self):
+        self.available = True
+        self._networks = {}
+
+    def network_for(self, handle, collect_types=()):
+        network = NetworkActivity(collect_types, router=self)
+        self._networks[_window_webview(handle)] = network
+        return network
+
+    def forget(self, handle):
+        self._networks.pop(_window_webview(handle), None)
+
+    def poll(self, driver):
+        if not self.available:
+            return
+        try:
+            entries = driver.get_log('performance')
+        except Exception:
+            self.available = False
+            return
+
+        for entry in entries:
+            message = json.loads(entry['message'])
+            network = self._networks.get(message.get('webview'))
+            if network is not None:
+                network.handle(message['message'])
+
+
+def wait_for_page_ready(
+        driver,
+        max_wait=PAGE_READY_MAX_WAIT,
+        quiet_period=PAGE_READY_QUIET_PERIOD,
+        poll_interval=PAGE_READY_POLL_INTERVAL,
+        network=None
+):
+    """
+    Polls until the document is complete, the network is quiet and the
+    iframe layout is stable for `quiet_period` seconds, or until `max_wait`
+    seconds pass. Returns a `PageReadiness`. Pass a `NetworkActivity` as
+    `network` to keep the events it reads.
+    """
+    start = time.monotonic()
+    if network is None:
+        network = NetworkActivity()
+    signature = None
+    stable_since = start
+    while True:
+        network.poll(driver)
+        new_signature = driver.execute_script(LAYOUT_SIGNATURE_SCRIPT)
+        now = time.monotonic()
+        if new_signature != signature:
+            signature = new_signature
+            stable_since = now
+
+        quiet_since = max(stable_since, network.last_event or start)
+        settled = (
+            signature.startswith('complete')
+            and len(network.in_flight) <= PAGE_READY_MAX_IN_FLIGHT
+            and now - quiet_since >= quiet_period
+        )
+        timed_out = now - start >= max_wait
+        if settled or timed_out:
+            return PageReadiness(
+                now - start, not settled, len(network.in_flight),
+                signature.count(';')
+            )
+        sleep(poll_interval)
+
+
+def _record_time_to_ready(url, readiness):
+    time_to_ready.setdefault(url, []).append(readiness)
+    print('Ready in {:.2f}s{}: {}'.format(
+        readiness.elapsed, ' (timed out)' if readiness.timed_out else '', url
+    ))
+
+
+# name -> (PIL format, save params) for the PNG bytes handed to AdLoader.
+CROP_ENCODINGS = {
+    'png': ('PNG', {}),
+    'fast_png': ('PNG', {'compress_level': 1}),
+    'webp_lossless': ('WEBP', {'lossless': True, 'quality': 0, 'method': 0}),
+}
+
+
+def encode_image(pil_image, encoding='png'):
+    """ Encodes a PIL image with one of `CROP_ENCODINGS` """
+    image_format, params = CROP_ENCODINGS[encoding]
+    output = BytesIO()
+    pil_image.save(output, format=image_format, **params)
+    # `getvalue` hands over the buffer instead of copying it like `read`.
+    return output.getvalue()
+
+
+class _BufferFile(object):
+    """ A read-only, seekable file over a bytes-like buffer. Only the chunks
+    PIL reads are copied, never the whole buffer. """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast('B')
+        self._position = 0
+
+    def read(self, size=-1):
+        start = self._position
+        end = len(self._view) if size is None or size < 0 else min(
+            start + size, len(self._view)
+        )
+        self._position = end
+        return self._view[start:end].tobytes()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+def open_png_bytes(png_bytes):
+    """ Opens PNG bytes, or any bytes-like buffer such as a memoryview, in
+    PIL without copying the buffer """
+    return Image.open(_BufferFile(png_bytes))
+
+
+def decode_base64_payload(payload):
+    """ The bytes of a base64 str from WebDriver or DevTools.
+    `binascii` reads the ASCII str in place; `base64.b64decode` would
+    first encode it to a second, bytes copy. """
+    return binascii.a2b_base64(payload)
+
+
+def screenshot_png(driver):
+    """ `driver.get_screenshot_as_png` without its str -> bytes copy of the
+    base64 payload """
+    return decode_base64_payload(driver.execute(Command.SCREENSHOT)['value'])
+
+
+def capture_ads_by_cropping(driver, ads, debug=False, encoding='png'):
+    """ Takes one full-page screenshot and crops every `(location, size)`
+    out of it, returning the encoded bytes per ad """
+    page_pil_image = open_png_bytes(screenshot_png(driver))
+    if debug:
+        page_pil_image.show()
+
+    ad_images_bytes = []
+    for ad in ads:
+        try:
+            location = ad[0]
+            size = ad[1]
+            left = location['x']
+            top = location['y']
+            right = location['x'] + size['width']
+            bottom = location['y'] + size['height']
+            ad_pil_image = page_pil_image.crop((left, top, right, bottom))
+            if debug:
+                ad_pil_image.show()
+
+            ad_images_bytes.append(encode_image(ad_pil_image, encoding))
+
+        except Exception as e:
+            print('Exception cropping image:', e)
+
+    return ad_images_bytes
+
+
+def capture_ads_by_clipping(driver, ads, debug=False, encoding='png'):
+    """ Asks Chrome for a PNG of each ad rectangle only
+    (`Page.captureScreenshot` with a clip), so the full page is never
+    decoded. Non-PNG encodings re-encode each clip. """
+    ad_images_bytes = []
+    for location, size in ads:
+        try:
+            result = driver.execute_cdp_cmd('Page.captureScreenshot', {
+                'format': 'png',
+                'captureBeyondViewport': True,
+                'clip': {
+                    'x': location['x'],
+                    'y': location['y'],
+                    'width': size['width'],
+                    'height': size['height'],
+                    'scale': 1
+                }
+            })
+            ad_image_bytes = decode_base64_payload(result['data'])
+            if debug:
+                open_png_bytes(ad_image_bytes).show()
+
+            if encoding != 'png':
+                ad_image_bytes = encode_image(
+                    open_png_bytes(ad_image_bytes), encoding
+                )
+            ad_images_bytes.append(ad_image_bytes)
+
+        except Exception as e:
+            print('Exception clipping image:', e)
+
+    return ad_images_bytes
+
+
+def capture_creatives_from_network(driver, network, min_side=MIN_CREATIVE_SIDE):
+    """
+    Returns the bytes of every finished response collected by `network`
+    whose URL, or the URL of the document that requested it, is an ad.
+    Bodies come from `Network.getResponseBody`, so creatives are exact and
+    no screenshot is taken. Repeats within the page, undecodable bodies and
+    images smaller than `min_side` (tracking pixels) are dropped.
+    """
+    responses = [
+        (request_id, response)
+        for request_id, response in network.responses.items()
+        if response['finished']
+    ]
+    verdicts = classify_urls(
+        [response['url'] for _, response in responses]
+        + [response['document_url'] for _, response in responses]
+    )
+
+    creatives = []
+    seen = set()
+    for request_id, response in responses:
+        if not (
+            verdicts.get(response['url'])
+            or verdicts.get(response['document_url'])
+        ):
+            continue
+        try:
+            result = driver.execute_cdp_cmd(
+                'Network.getResponseBody', {'requestId': request_id}
+            )
+            if result['base64Encoded']:
+                body = decode_base64_payload(result['body'])
+            else:
+                body = result['body'].encode('utf-8')
+
+            digest = hashlib.sha1(body).digest()
+            if digest in seen:
+                continue
+            seen.add(digest)
+
+            if response['type'] == 'Image':
+                width, height = open_png_bytes(body).size
+                if min(width, height) < min_side:
+                    continue
+            creatives.append(body)
+
+        except Exception as e:
+            print('Exception getting response body:', response['url'], e)
+
+    return creatives
+
+
+AD_CAPTURES = {
+    'crop': capture_ads_by_cropping,
+    'clip': capture_ads_by_clipping,
+}
+
+
+# `capture` value of `get_ad_images_from_url` that skips screenshots and
+# takes creatives from response bodies.
+NETWORK_CAPTURE = 'network'
+
+
+def _get_ad_images_from_loaded_page(
+        driver, network, debug, detection, capture, encoding
+):
+    if capture == NETWORK_CAPTURE:
+        return capture_creatives_from_network(driver, network)
+
+    ads = AD_FINDERS[detection](driver)
+    if not ads:
+        return []
+    return AD_CAPTURES[capture](driver, ads, debug=debug, encoding=encoding)
+
+
+def get_ad_images_from_url(
+        driver,
+        url,
+        debug=False,
+        detection='frames',
+        capture='crop',
+        encoding='png',
+        quit_driver=True
+):
+    """
+    Loads `url`, finds the ad iframes with the `AD_FINDERS[detection]`
+    strategy and returns each ad as image bytes captured by the
+    `AD_CAPTURES[capture]` strategy and encoded with
+    `CROP_ENCODINGS[encoding]`. With `capture=NETWORK_CAPTURE` the ad
+    creatives are returned as served, straight from the network, and
+    neither detection nor the large window is needed. The driver is quit
+    afterwards unless `quit_driver` is False.
+    """
     #chrome_options = Options()
     #chrome_options.add_argument("--headless")
     #chrome_options.add_argument("--incognito")
     #chrome_options.add_argument('--user-agent=%s' % USER_AGENT)
     #driver = webdriver.Chrome(options=chrome_options)
-    page_pil_image = None
+    ad_images_bytes = []
     try:
+        network = NetworkActivity(
+            CREATIVE_RESOURCE_TYPES if capture == NETWORK_CAPTURE else ()
+        )
+        drain_performance_log(driver)
         driver.get(url)
-        sleep(5)
-        driver.set_window_size(2160, 4096)
-        sleep(1)
-        all_iframes = driver.find_elements_by_tag_name("iframe")
-        for iframe in all_iframes:
-            try:
-                iframe_location = iframe.location
-                iframe_size = iframe.size
-                driver.switch_to.frame(iframe)
-                is_ad = check_if_iframe_is_ad(driver)
-                if is_ad:
-                    ads.append((iframe_location, iframe_size))
-
-            except Exception as e:
-                print("Exception getting iframe:", e)
-
-            finally:
-                driver.switch_to.default_content()
-
-        page_base64_image = driver.get_screenshot_as_base64()
-        page_pil_image = Image.open(
-            BytesIO(base64.decodebytes(page_base64_image.encode()))
+        readiness = wait_for_page_ready(driver, network=network)
+        if capture != NETWORK_CAPTURE:
+            driver.set_window_size(2160, 4096)
+            resize_readiness = wait_for_page_ready(
+                driver, max_wait=RESIZE_READY_MAX_WAIT, network=network
+            )
+            readiness = readiness._replace(
+                elapsed=readiness.elapsed + resize_readiness.elapsed,
+                timed_out=readiness.timed_out or resize_readiness.timed_out
+            )
+        _record_time_to_ready(url, readiness)
+        ad_images_bytes = _get_ad_images_from_loaded_page(
+            driver, network, debug, detection, capture, encoding
         )
-        if debug:
-            page_pil_image.show()
 
     except Exception as e:
         print("Exception using driver:", e)
 
     finally:
-        driver.quit()
+        if quit_driver:
+            driver.quit()
 
-    ad_images_bytes = []
-    if page_pil_image:
-        for ad in ads:
+    return ad_images_bytes
+
+
+# Seconds from navigation start to the load event, or null while loading.
+NAVIGATION_DURATION_SCRIPT = """
+var timing = performance.timing;
+if (!timing.loadEventEnd) return null;
+return (timing.loadEventEnd - timing.navigationStart) / 1000;
+"""
+
+# url -> list of seconds of each visit's load that overlapped the previous
+# page's analysis in `get_ad_images_pipelined`
+hidden_latency = {}
+
+
+def get_ad_images_pipelined(
+        driver,
+        urls,
+        depth=PIPELINE_DEPTH,
+        debug=False,
+        detection='frames',
+        capture='crop',
+        encoding='png',
+        blocking_profile=None
+):
+    """
+    Yields `(url, ad images bytes)` for each of `urls`, like
+    `get_ad_images_from_url`, while the next `depth` URLs already load in
+    background tabs. Each tab gets its own `NetworkActivity` through a
+    `PerformanceLogRouter`, and is closed once analyzed. The window is
+    sized for capture before loading starts. The driver is left on the
+    last page's tab and is not quit.
+
+    DevTools settings are per tab, so pass the driver's
+    `resource_blocking.ResourceBlockingProfile` to have it applied to the
+    background tabs before they load.
+    """
+    urls = list(urls)
+    if not urls:
+        return
+
+    router = PerformanceLogRouter()
+    collect_types = (
+        CREATIVE_RESOURCE_TYPES if capture == NETWORK_CAPTURE else ()
+    )
+    if capture != NETWORK_CAPTURE:
+        driver.set_window_size(2160, 4096)
+    drain_performance_log(driver)
+
+    tabs = deque()
+
+    def load(url, handle=None):
+        if handle is None and blocking_profile is not None:
+            current = driver.current_window_handle
+            handle = open_tab(driver)
+            switch_to_tab(driver, handle)
+            blocking_profile.apply(driver)
+            driver.execute_script('window.location.href = arguments[0]', url)
+            switch_to_tab(driver, current)
+        elif handle is None:
+            handle = open_tab(driver, url)
+        else:
+            driver.execute_script('window.location.href = arguments[0]', url)
+        network = router.network_for(handle, collect_types)
+        tabs.append((url, handle, network, time.monotonic()))
+
+    def preload(url):
+        """ `load` in a background tab; on failure the URL is queued without
+        a tab, so only its own page is lost """
+        current = driver.current_window_handle
+        try:
+            load(url)
+        except Exception as e:
+            print("Exception preloading {}: {}".format(url, e))
+            tabs.append((url, None, None, None))
             try:
-                location = ad[0]
-                size = ad[1]
-                left = location['x']
-                top = location['y']
-                right = location['x'] + size['width']
-                bottom = location['y'] + size['height']
-                output = BytesIO()
-                ad_pil_image = page_pil_image.crop((left, top, right, bottom))
-                if debug:
-                    ad_pil_image.show()
-
-                ad_pil_image.save(output, format='PNG')
-                output.seek(0)
-                ad_images_bytes.append(output.read())
+                switch_to_tab(driver, current)
+            except Exception:
+                pass
+
+    load(urls[0], driver.current_window_handle)
+    next_index = 1
+    while tabs:
+        url, handle, network, opened_at = tabs.popleft()
+        if handle is None:
+            yield url, []
+            continue
 
+        ad_images_bytes = []
+        try:
+            switch_to_tab(driver, handle)
+            overlap = time.monotonic() - opened_at
+            # Start the next pages before this one is analyzed.
+            while next_index < len(urls) and len(tabs) < depth:
+                preload(urls[next_index])
+                next_index += 1
+
+            readiness = wait_for_page_ready(driver, network=network)
+            _record_time_to_ready(url, readiness)
+            load_time = driver.execute_script(NAVIGATION_DURATION_SCRIPT)
+            hidden = overlap if load_time is None else min(overlap, load_time)
+            hidden_latency.setdefault(url, []).append(hidden)
+            print('Hidden {:.2f}s of loading: {}'.format(hidden, url))
+
+            ad_images_bytes = _get_ad_images_from_loaded_page(
+                driver, network, debug, detection, capture, encoding
+            )
+
+        except Exception as e:
+            print("Exception using driver:", e)
+
+        finally:
+            router.forget(handle)
+            try:
+                if any(tab[1] is not None for tab in tabs):
+                    driver.close()
+                elif next_index < len(urls):
+                    # No background tab (depth 0 or failed preloads): reuse
+                    # this one.
+                    load(urls[next_index], handle)
+                    next_index += 1
             except Exception as e:
-                print('Exception cropping image:', e)
+                print("Exception recycling tab:", e)
 
-    return ad_images_bytes
+        yield url, ad_images_bytes
@@ -0,0 +1,285 @@
+import json
+import socket
+import asyncio
+import base64
+
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.remote.webdriver import _make_w3c_caps
+
+CHROMEDRIVER_PATH = 'chromedriver'
+CHROMEDRIVER_START_TIMEOUT = 10
+
+# W3C key of element references in requests and responses.
+ELEMENT_KEY = 'element-6066-11e4-a52e-4f735466cecf'
+
+# `By` strategies that W3C chromedriver only knows as CSS selectors, like
+# selenium's `find_elements` rewrites them.
+_CSS_STRATEGIES = {
+    'id': '[id="{}"]',
+    'tag name': '{}',
+    'class name': '.{}',
+    'name': '[name="{}"]',
+}
+
+
+class _HttpConnection(object):
+    """
+    One keep-alive HTTP/1.1 connection to chromedriver, for JSON commands.
+    Requests on it are sent one at a time.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    async def request(self, method, path, payload=None):
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        head = (
+            '{} {} HTTP/1.1\r\nHost: {}:{}\r\n'
+            'Content-Type: application/json;charset=UTF-8\r\n'
+            'Content-Length: {}\r\nConnection: keep-alive\r\n\r\n'
+        ).format(method, path, self.host, self.port, len(body))
+
+        async with self._lock:
+            if self._writer is None:
+                self._reader, self._writer = await asyncio.open_connection(
+                    self.host, self.port
+                )
+            try:
+                self._writer.write(head.encode('ascii') + body)
+                await self._writer.drain()
+                status, headers, data = await self._read_response()
+            except BaseException:
+                # Includes cancellation: a reply left unread on the socket
+                # would be taken for the next command's.
+                self.close()
+                raise
+            if headers.get('connection', '').lower() == 'close':
+                self.close()
+        return status, json.loads(data.decode('utf-8')) if data else {}
+
+    async def _read_response(self):
+        status = int((await self._reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await self._reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self._reader.readline()).split(b';')[0], 16)
+                chunk = await self._reader.readexactly(size + 2)
+                if not size:
+                    break
+                chunks.append(chunk[:-2])
+            return status, headers, b''.join(chunks)
+
+        length = int(headers.get('content-length', 0))
+        return status, headers, await self._reader.readexactly(length)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class AsyncElement(object):
+    """ A W3C element reference returned by `AsyncSession` """
+
+    def __init__(self, session, element_id):
+        self.session = session
+        self.id = element_id
+
+    def __eq__(self, other):
+        return isinstance(other, AsyncElement) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class AsyncSession(object):
+    """
+    One browser session of chromedriver, with coroutine versions of the
+    WebDriver calls the crawler uses. Each session has its own connection,
+    so sessions run concurrently while one session's commands stay ordered.
+    """
+
+    def __init__(self, host, port, session_id):
+        self.session_id = session_id
+        self._connection = _HttpConnection(host, port)
+
+    async def execute(self, method, command, payload=None):
+        """ Sends a session command, e.g. ('POST', '/url', {'url': url}),
+        and returns its value. Raises WebDriverException on errors. """
+        path = '/session/{}{}'.format(self.session_id, command)
+        status, response = await self._connection.request(
+            method, path, payload
+        )
+        value = response.get('value')
+        error = value if isinstance(value, dict) else {}
+        if status >= 400 or 'error' in error:
+            raise WebDriverException('{}: {}'.format(
+                error.get('error', status), error.get('message')
+            ))
+        return self._unwrap(value)
+
+    def _wrap(self, value):
+        if isinstance(value, AsyncElement):
+            return {ELEMENT_KEY: value.id}
+        if isinstance(value, dict):
+            return {key: self._wrap(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self._wrap(item) for item in value]
+        return value
+
+    def _unwrap(self, value):
+        if isinstance(value, dict):
+            if ELEMENT_KEY in value:
+                return AsyncElement(self, value[ELEMENT_KEY])
+            return {key: self._unwrap(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._unwrap(item) for item in value]
+        return value
+
+    async def get(self, url):
+        await self.execute('POST', '/url', {'url': url})
+
+    async def current_url(self):
+        return await self.execute('GET', '/url')
+
+    async def execute_script(self, script, *args):
+        return await self.execute(
+            'POST', '/execute/sync',
+            {'script': script, 'args': self._wrap(list(args))}
+        )
+
+    async def execute_async_script(self, script, *args):
+        return await self.execute(
+            'POST', '/execute/async',
+            {'script': script, 'args': self._wrap(list(args))}
+        )
+
+    async def get_screenshot_as_png(self):
+        return base64.b64decode(await self.execute('GET', '/screenshot'))
+
+    async def find_elements(self, by, value):
+        """ `by` is a selenium `By` value, e.g. 'xpath' or 'css selector' """
+        if by in _CSS_STRATEGIES:
+            by, value = 'css selector', _CSS_STRATEGIES[by].format(value)
+        return await self.execute(
+            'POST', '/elements', {'using': by, 'value': value}
+        )
+
+    async def set_window_size(self, width, height):
+        await self.execute(
+            'POST', '/window/rect', {'width': width, 'height': height}
+        )
+
+    async def execute_cdp_cmd(self, cmd, params=None):
+        return await self.execute(
+            'POST', '/goog/cdp/execute', {'cmd': cmd, 'params': params or {}}
+        )
+
+    async def get_log(self, log_type):
+        return await self.execute('POST', '/log', {'type': log_type})
+
+    async def quit(self):
+        try:
+            await self.execute('DELETE', '')
+        finally:
+            self._connection.close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class AsyncChromeDriver(object):
+    """
+    A chromedriver process that hosts any number of `AsyncSession`s, all
+    steered from one event loop:
+
+        async with AsyncChromeDriver() as chromedriver:
+            session = await chromedriver.new_session(chrome_options)
+            await session.get(url)
+
+    Pass `port` to use a chromedriver that is already running.
+    """
+
+    def __init__(self, executable=CHROMEDRIVER_PATH, port=None):
+        self.executable = executable
+        self.host = '127.0.0.1'
+        self.port = port
+        self._process = None
+        self._connection = None
+
+    async def start(self):
+        if self.port is None:
+            self.port = _free_port()
+            self._process = await asyncio.create_subprocess_exec(
+                self.executable, '--port={}'.format(self.port),
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL
+            )
+        self._connection = _HttpConnection(self.host, self.port)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + CHROMEDRIVER_START_TIMEOUT
+        while True:
+            try:
+                status, response = await self._connection.request(
+                    'GET', '/status'
+                )
+                if status == 200 and response['value'].get('ready', True):
+                    return self
+            except OSError:
+                self._connection.close()
+            if loop.time() > deadline:
+                await self.stop()
+                raise WebDriverException(
+                    'chromedriver did not start on port {}'.format(self.port)
+                )
+            await asyncio.sleep(0.1)
+
+    async def new_session(self, options):
+        """ Starts a browser with selenium ChromeOptions `options` """
+        capabilities = options.to_capabilities()
+        # W3C names only, as selenium sends them; 'any' is no platform.
+        w3c_capabilities = _make_w3c_caps(capabilities)
+        always_match = w3c_capabilities['alwaysMatch']
+        if always_match.get('platformName') == 'any':
+            del always_match['platformName']
+        status, response = await self._connection.request(
+            'POST', '/session', {
+                'capabilities': w3c_capabilities,
+                'desiredCapabilities': capabilities
+            }
+        )
+        value = response.get('value', {})
+        if status >= 400 or 'error' in value:
+            raise WebDriverException('{}: {}'.format(
+                value.get('error'), value.get('message')
+            ))
+        return AsyncSession(self.host, self.port, value['sessionId'])
+
+    async def stop(self):
+        if self._connection is not None:
+            self._connection.close()
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+            await self._process.wait()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
@@ -0,0 +1,917 @@
+import argparse
+import asyncio
+import base64
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import (
+    BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+)
+
+from adblockparser import AdblockRules
+
+from six import BytesIO
+from PIL import Image
+
+from ad_images import (
+    AD_CAPTURES, AD_FINDERS, CROP_ENCODINGS, EASYLIST_PATH,
+    RESIZE_READY_MAX_WAIT, NetworkActivity, capture_ads_by_cropping,
+    classify_urls, drain_performance_log, get_ad_matcher,
+    get_iframe_links, open_png_bytes, url_verdict_cache, wait_for_page_ready
+)
+from async_driver import AsyncChromeDriver
+from resource_blocking import ResourceBlockingProfile, blocked_ads
+
+
+def load_url_corpus(corpus_path):
+    with open(corpus_path, 'r') as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def record_url_corpus(driver, site_urls, corpus_path):
+    """ Visit each site and append every link found inside its iframes to
+    `corpus_path`, one URL per line """
+    with open(corpus_path, 'a') as corpus:
+        for site_url in site_urls:
+            driver.get(site_url)
+            time.sleep(5)
+            for iframe in driver.find_elements_by_tag_name('iframe'):
+                try:
+                    driver.switch_to.frame(iframe)
+                    for link in get_iframe_links(driver):
+                        corpus.write(link + '\n')
+
+                except Exception as e:
+                    print('Exception recording iframe:', e)
+
+                finally:
+                    driver.switch_to.default_content()
+
+
+def bench_link_harvest(driver, site_urls, timings_path):
+    """ Times both link-harvesting modes on every iframe of each site and
+    appends `site, iframe, per-element s, script s, links` rows to
+    `timings_path` """
+    totals = {False: 0.0, True: 0.0}
+    num_iframes = 0
+    with open(timings_path, 'a') as timings:
+        for site_url in site_urls:
+            driver.get(site_url)
+            time.sleep(5)
+            iframes = driver.find_elements_by_tag_name('iframe')
+            for i, iframe in enumerate(iframes):
+                elapsed = {}
+                links = {}
+                try:
+                    driver.switch_to.frame(iframe)
+                    for use_script in (False, True):
+                        start = time.perf_counter()
+                        links[use_script] = get_iframe_links(
+                            driver, use_script=use_script
+                        )
+                        elapsed[use_script] = time.perf_counter() - start
+
+                except Exception as e:
+                    print('Exception harvesting iframe:', e)
+                    continue
+
+                finally:
+                    driver.switch_to.default_content()
+
+                num_iframes += 1
+                for use_script in elapsed:
+                    totals[use_script] += elapsed[use_script]
+                timings.write('{}\t{}\t{:.4f}\t{:.4f}\t{}\n'.format(
+                    site_url, i, elapsed[False], elapsed[True],
+                    len(links[True])
+                ))
+                if sorted(links[False]) != sorted(links[True]):
+                    print('WARNING: harvested links differ:', site_url, i)
+
+    if num_iframes:
+        print('per-element : {:8.4f} s/iframe'.format(
+            totals[False] / num_iframes
+        ))
+        print('script      : {:8.4f} s/iframe'.format(
+            totals[True] / num_iframes
+        ))
+        print('iframes     : {}'.format(num_iframes))
+
+
+@contextmanager
+def serve_fixtures(fixtures_dir):
+    """ Serves `fixtures_dir` on a free localhost port and yields the URL of
+    every `.html` file in it """
+    handler = functools.partial(
+        SimpleHTTPRequestHandler, directory=fixtures_dir
+    )
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield [
+            'http://127.0.0.1:{}/{}'.format(server.server_port, name)
+            for name in sorted(os.listdir(fixtures_dir))
+            if name.endswith('.html')
+        ]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_ad_detection(driver, site_urls, timings_path):
+    """ Runs every `AD_FINDERS` strategy on each site, appends `site,
+    finder, s, ads` rows to `timings_path` and flags sites where the
+    strategies disagree """
+    totals = dict.fromkeys(AD_FINDERS, 0.0)
+    with open(timings_path, 'a') as timings:
+        for site_url in site_urls:
+            driver.get(site_url)
+            time.sleep(5)
+            found = {}
+            for name, find_ads in sorted(AD_FINDERS.items()):
+                start = time.perf_counter()
+                found[name] = find_ads(driver)
+                elapsed = time.perf_counter() - start
+                totals[name] += elapsed
+                timings.write('{}\t{}\t{:.4f}\t{}\n'.format(
+                    site_url, name, elapsed, len(found[name])
+                ))
+
+            rects = set(
+                tuple(sorted(
+                    (ad[0]['x'], ad[0]['y'], round(ad[1]['width']),
+                     round(ad[1]['height']))
+                    for ad in ads
+                ))
+                for ads in found.values()
+            )
+            if len(rects) > 1:
+                print('WARNING: ad finders disagree on', site_url)
+
+    for name in sorted(totals):
+        print('{:10}: {:8.4f} s/site'.format(
+            name, totals[name] / len(site_urls) if site_urls else 0.0
+        ))
+
+
+def bench_ad_capture(driver, site_urls, timings_path):
+    """ Runs every `AD_CAPTURES` strategy on the ads of each site and
+    appends `site, capture, s, Python heap peak, RSS growth, ads, bytes`
+    rows to `timings_path`. The Python heap peak comes from tracemalloc;
+    PIL's pixel buffers only show up in the RSS growth. """
+    totals = {name: [0.0, 0] for name in AD_CAPTURES}
+    with open(timings_path, 'a') as timings:
+        for site_url in site_urls:
+            driver.get(site_url)
+            wait_for_page_ready(driver)
+            driver.set_window_size(2160, 4096)
+            wait_for_page_ready(driver, max_wait=RESIZE_READY_MAX_WAIT)
+            ads = AD_FINDERS['frames'](driver)
+            if not ads:
+                continue
+
+            # Clip first: RSS only grows, so the crop run shows its excess.
+            for name in sorted(AD_CAPTURES):
+                rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                tracemalloc.start()
+                start = time.perf_counter()
+                ad_images_bytes = AD_CAPTURES[name](driver, ads)
+                elapsed = time.perf_counter() - start
+                heap_peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                rss_growth = (
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    - rss_before
+                )
+
+                totals[name][0] += elapsed
+                totals[name][1] = max(totals[name][1], heap_peak)
+                timings.write('{}\t{}\t{:.4f}\t{}\t{}\t{}\t{}\n'.format(
+                    site_url, name, elapsed, heap_peak, rss_growth * 1024,
+                    len(ad_images_bytes), sum(map(len, ad_images_bytes))
+                ))
+
+    for name in sorted(totals):
+        elapsed, heap_peak = totals[name]
+        print('{:6}: {:8.3f} s total, {:8.1f} MB peak Python heap'.format(
+            name, elapsed, heap_peak / 1e6
+        ))
+
+
+# Common IAB ad sizes, laid out down the page for the decode benchmark.
+BENCH_AD_SIZES = [(300, 250), (728, 90), (160, 600), (320, 50), (970, 250)]
+
+
+def _bench_ads(page_width, page_height):
+    ads = []
+    top = 0
+    for width, height in BENCH_AD_SIZES * 4:
+        if top + height > page_height or width > page_width:
+            break
+        ads.append(({'x': 0, 'y': top}, {'width': width, 'height': height}))
+        top += height
+    return ads
+
+
+def _legacy_decode_and_crop(page_base64_image, ads):
+    # Behaviour before raw PNG bytes: str -> bytes -> decodebytes -> BytesIO,
+    # then default-level PNG per crop read back through seek/read.
+    page_pil_image = Image.open(
+        BytesIO(base64.decodebytes(page_base64_image.encode()))
+    )
+    ad_images_bytes = []
+    for location, size in ads:
+        output = BytesIO()
+        page_pil_image.crop((
+            location['x'], location['y'],
+            location['x'] + size['width'], location['y'] + size['height']
+        )).save(output, format='PNG')
+        output.seek(0)
+        ad_images_bytes.append(output.read())
+    return ad_images_bytes
+
+
+class _ScreenshotDriver(object):
+    # Answers the WebDriver screenshot command with a recorded payload.
+    def __init__(self, page_base64_image):
+        self.page_base64_image = page_base64_image
+
+    def execute(self, command):
+        return {'value': self.page_base64_image}
+
+
+def bench_screenshot_decode(screenshot_path, repeat=5):
+    """ CPU time and peak Python allocations per page for the legacy base64
+    decode and PNG crops against `capture_ads_by_cropping` with every
+    `CROP_ENCODINGS`, on a recorded full-page screenshot. The allocations
+    (tracemalloc) cover the payload copies, not PIL's pixel buffers. """
+    with open(screenshot_path, 'rb') as file:
+        png_bytes = file.read()
+    page_base64_image = base64.b64encode(png_bytes).decode()
+    ads = _bench_ads(*open_png_bytes(png_bytes).size)
+    driver = _ScreenshotDriver(page_base64_image)
+
+    def run(decode_and_crop, *args, **kwargs):
+        start = time.process_time()
+        for _ in range(repeat):
+            ad_images_bytes = decode_and_crop(*args, **kwargs)
+        cpu = (time.process_time() - start) / repeat
+
+        tracemalloc.start()
+        decode_and_crop(*args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return cpu, peak, ad_images_bytes
+
+    legacy_cpu, legacy_peak, legacy_crops = run(
+        _legacy_decode_and_crop, page_base64_image, ads
+    )
+    print('{:14}: {:8.1f} ms CPU/page, {:8.2f} MB peak, {:8.1f} kB '
+          'crops'.format('legacy', legacy_cpu * 1e3, legacy_peak / 1e6,
+                         sum(map(len, legacy_crops)) / 1e3))
+
+    for encoding in sorted(CROP_ENCODINGS):
+        try:
+            cpu, peak, crops = run(
+                capture_ads_by_cropping, driver, ads, encoding=encoding
+            )
+        except (IOError, KeyError) as e:
+            print('{:14}: unavailable ({})'.format(encoding, e))
+            continue
+        print('{:14}: {:8.1f} ms CPU/page, {:8.2f} MB peak, {:8.1f} kB '
+              'crops, {:6.1f} ms saved'.format(
+                  encoding, cpu * 1e3, peak / 1e6,
+                  sum(map(len, crops)) / 1e3, (legacy_cpu - cpu) * 1e3
+              ))
+
+
+def _legacy_check_if_ad(url):
+    # Behaviour before the shared matcher: re-read and re-compile per URL.
+    with open(EASYLIST_PATH, 'r') as file:
+        raw_rules = file.readlines()
+    rules = AdblockRules(raw_rules)
+    return rules.should_block(url)
+
+
+def _urls_per_second(check, urls):
+    start = time.perf_counter()
+    verdicts = [check(url) for url in urls]
+    elapsed = time.perf_counter() - start
+    return len(urls) / elapsed if elapsed else float('inf'), verdicts
+
+
+def bench_check_if_ad(corpus_path, legacy_sample=10):
+    urls = load_url_corpus(corpus_path)
+
+    legacy_urls = urls[:legacy_sample]
+    legacy_rate, legacy_verdicts = _urls_per_second(
+        _legacy_check_if_ad, legacy_urls
+    )
+    print('legacy   : {:10.2f} URLs/s ({} URLs)'.format(
+        legacy_rate, len(legacy_urls)
+    ))
+
+    start = time.perf_counter()
+    get_ad_matcher().rules
+    print('warm-up  : {:10.2f} s (cache load + compile)'.format(
+        time.perf_counter() - start
+    ))
+
+    shared_rate, shared_verdicts = _urls_per_second(
+        get_ad_matcher().should_block, urls
+    )
+    print('shared   : {:10.2f} URLs/s ({} URLs, {} ads)'.format(
+        shared_rate, len(urls), sum(shared_verdicts)
+    ))
+    print('speedup  : {:10.1f}x'.format(shared_rate / legacy_rate))
+
+    if shared_verdicts[:len(legacy_verdicts)] != legacy_verdicts:
+        print('WARNING: verdicts differ from the legacy matcher')
+
+
+def bench_rule_engine(corpus_path):
+    """ Differential check and speed comparison of the token-indexed engine
+    against `AdblockRules` built from the same rules """
+    urls = load_url_corpus(corpus_path)
+    matcher = get_ad_matcher()
+    reference = AdblockRules(matcher.raw_rules)
+
+    reference_rate, reference_verdicts = _urls_per_second(
+        reference.should_block, urls
+    )
+    print('AdblockRules : {:10.2f} URLs/s'.format(reference_rate))
+    indexed_rate, indexed_verdicts = _urls_per_second(
+        matcher.should_block, urls
+    )
+    print('token index  : {:10.2f} URLs/s'.format(indexed_rate))
+    print('speedup      : {:10.1f}x'.format(indexed_rate / reference_rate))
+
+    mismatches = [
+        url for url, expected, actual
+        in zip(urls, reference_verdicts, indexed_verdicts)
+        if expected != actual
+    ]
+    print('verdicts     : {} URLs, {} ads, {} mismatches'.format(
+        len(urls), sum(reference_verdicts), len(mismatches)
+    ))
+    for url in mismatches:
+        print('  mismatch:', url)
+
+
+def bench_classify_urls(corpus_path, batch_size=200):
+    """ Replays the corpus in page-sized batches through `classify_urls`
+    and reports the verdict cache's hit rate """
+    urls = load_url_corpus(corpus_path)
+    get_ad_matcher()
+    url_verdict_cache.clear()
+
+    start = time.perf_counter()
+    for i in range(0, len(urls), batch_size):
+        classify_urls(urls[i:i + batch_size])
+    elapsed = time.perf_counter() - start
+
+    info = url_verdict_cache.info()
+    lookups = info.hits + info.misses
+    print('batched  : {:10.2f} URLs/s ({} URLs)'.format(
+        len(urls) / elapsed if elapsed else float('inf'), len(urls)
+    ))
+    print('cache    : {} hits, {} misses ({:.1%} hit rate), {}/{} '
+          'entries'.format(
+              info.hits, info.misses, info.hits / lookups if lookups else 0.0,
+              info.currsize, info.maxsize
+          ))
+
+
+# The stand-in answers every request after this many seconds, like a
+# round trip to a nearby cluster.
+ES_STANDIN_LATENCY = 0.002
+UPSERT_BENCH_WRITERS = 8
+UPSERT_BENCH_SIGHTINGS = 200
+
+
+class _ESStandInHandler(BaseHTTPRequestHandler):
+    """ The document APIs `AdLoader` writes through, on an in-memory index:
+    index creation and its mapping, an ID scroll, get, create and update
+    with a partial doc or the `APPEND_SOURCES_SCRIPT` upsert. Each
+    document is changed under a lock, as Elasticsearch does per shard. """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        data = json.dumps(payload).encode('utf-8')
+        time.sleep(ES_STANDIN_LATENCY)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.server.lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['bytes_out'] += len(data)
+
+    @staticmethod
+    def _error(status, error_type):
+        return status, {
+            'error': {'type': error_type, 'reason': error_type},
+            'status': status
+        }
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'null')
+        with self.server.lock:
+            self.server.stats['bytes_in'] += length
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) == 1:
+            if body and not self.server.mappings:
+                self.server.mappings = body.get('mappings', {})
+            return self._reply(200, {'acknowledged': True})
+        if parts[1] == '_mapping':
+            return self._reply(200, {
+                parts[0]: {'mappings': self.server.mappings}
+            })
+        if parts[0] == '_search':
+            # Scroll continuation: the first page held every hit.
+            return self._reply(200, {
+                '_scroll_id': 'standin',
+                '_shards': {'total': 1, 'successful': 1},
+                'hits': {'hits': []}
+            })
+
+        with self.server.lock:
+            status, payload = self._apply(parts, body)
+        self._reply(status, payload)
+
+    def _apply(self, parts, body):
+        from data_access import APPEND_SOURCES_SCRIPT, METADATA_SOURCES_KEY
+
+        index, doc_type, _id = parts[:3]
+        documents = self.server.documents
+        document = documents.get(_id)
+        if _id == '_search':
+            return 200, {
+                '_scroll_id': 'standin',
+                '_shards': {'total': 1, 'successful': 1},
+                'hits': {'hits': [{'_id': _id} for _id in documents]}
+            }
+
+        if len(parts) == 3 and self.command == 'GET':
+            if document is None:
+                return 404, {'_id': _id, 'found': False}
+            return 200, {
+                '_index': index, '_type': doc_type, '_id': _id,
+                '_version': document['_version'], 'found': True,
+                '_source': document['_source']
+            }
+
+        if parts[3] == '_create':
+            if document is not None:
+                return self._error(409, 'version_conflict_engine_exception')
+            documents[_id] = {'_version': 1, '_source': body}
+            return 201, {'_id': _id, 'result': 'created'}
+
+        if document is None:
+            if 'upsert' not in body:
+                return self._error(404, 'document_missing_exception')
+            documents[_id] = {'_version': 1, '_source': body['upsert']}
+            return 201, {'_id': _id, 'result': 'created'}
+
+        if 'script' in body:
+            assert body['script']['source'] == APPEND_SOURCES_SCRIPT
+            document['_source']['metadata'][METADATA_SOURCES_KEY].extend(
+                body['script']['params']['sources']
+            )
+        else:
+            for key, value in body['doc'].items():
+                if isinstance(value, dict):
+                    document['_source'].setdefault(key, {}).update(value)
+                else:
+                    document['_source'][key] = value
+        document['_version'] += 1
+        return 200, {'_id': _id, 'result': 'updated'}
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+
+@contextmanager
+def serve_es_standin():
+    """ Runs an `_ESStandInHandler` on a free localhost port and yields the
+    server; its `documents` and `stats` can be inspected afterwards """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ESStandInHandler)
+    server.daemon_threads = True
+    server.documents = {}
+    server.mappings = {}
+    server.lock = threading.Lock()
+    server.stats = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _legacy_add_image(loader, image_signature, image, image_url, source,
+                      retry_num=0):
+    # Behaviour before the scripted upsert: read the whole document, append
+    # in Python, write it back; create it, retrying on conflicts, if absent.
+    from elasticsearch.exceptions import ConflictError, NotFoundError
+    from data_access import MAX_CONFLICT_RETRIES, METADATA_SOURCES_KEY
+
+    es, aes = loader._es, loader._aes
+    _id = loader._signature_id(image_signature)
+    try:
+        try:
+            document = es.get(
+                index=aes.index, doc_type=aes.doc_type, id=_id
+            )['_source']
+        except NotFoundError:
+            record = loader._make_record(
+                image_signature, image, image_url, [source]
+            )
+            es.create(
+                index=aes.index, doc_type=aes.doc_type, id=_id, body=record
+            )
+            return
+        document['metadata'][METADATA_SOURCES_KEY].append(source)
+        es.update(
+            index=aes.index, doc_type=aes.doc_type, id=_id,
+            body={'doc': document}
+        )
+    except ConflictError:
+        if retry_num >= MAX_CONFLICT_RETRIES:
+            raise
+        _legacy_add_image(
+            loader, image_signature, image, image_url, source, retry_num + 1
+        )
+
+
+def bench_upsert(images_dir):
+    """ `UPSERT_BENCH_WRITERS` threads record `UPSERT_BENCH_SIGHTINGS`
+    sightings each of the ad images in `images_dir` on a fresh
+    `serve_es_standin`: with the legacy get-then-update, with `AdLoader`'s
+    scripted upsert, and with the upsert behind its `KnownIdCache`.
+    Reports throughput, traffic and how many sightings made it into the
+    index. """
+    import logging
+    import random
+    from data_access import (
+        AdLoader, ImageSignatureService, METADATA_SOURCES_KEY
+    )
+
+    # The legacy path's misses are logged as warnings by the client.
+    logging.getLogger('elasticsearch').setLevel(logging.ERROR)
+    service = ImageSignatureService()
+    creatives = []
+    for name in sorted(os.listdir(images_dir)):
+        with open(os.path.join(images_dir, name), 'rb') as file:
+            image_signature, image = service.get_image_signature_from_bytes(
+                file.read()
+            )
+        if image_signature:
+            creatives.append((image_signature, image, name))
+    print('creatives: {} from {}'.format(len(creatives), images_dir))
+
+    def add_legacy(loader, creative, source):
+        _legacy_add_image(loader, creative[0], creative[1], creative[2],
+                          loader._make_source(*source))
+
+    def add_upsert(loader, creative, source):
+        loader._add_image(creative[0], creative[1], creative[2], *source)
+
+    modes = (
+        ('legacy', add_legacy, False),
+        ('upsert', add_upsert, False),
+        ('known', add_upsert, True),
+    )
+    for mode, add, use_known_ids in modes:
+        with serve_es_standin() as server:
+            loader = AdLoader(
+                'bench', hosts=['127.0.0.1:{}'.format(server.server_port)],
+                use_phash_index=False, use_known_ids=use_known_ids,
+                use_blob_store=False
+            )
+            errors = []
+
+            def writer(seed):
+                rng = random.Random(seed)
+                for i in range(UPSERT_BENCH_SIGHTINGS):
+                    source = ('http://site{}.example/'.format(i), seed,
+                              '25-34', 'female', [])
+                    try:
+                        add(loader, rng.choice(creatives), source)
+                    except Exception as e:
+                        errors.append(e)
+
+            threads = [
+                threading.Thread(target=writer, args=(seed,))
+                for seed in range(UPSERT_BENCH_WRITERS)
+            ]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            sent = UPSERT_BENCH_WRITERS * UPSERT_BENCH_SIGHTINGS
+            stored = sum(
+                len(document['_source']['metadata'][METADATA_SOURCES_KEY])
+                for document in server.documents.values()
+            )
+            stats = server.stats
+            print('{:6}: {:8.1f} sightings/s, {:5} requests, {:7.2f} MB '
+                  'sent, {:7.2f} MB received, {}/{} sightings stored, {} '
+                  'errors'.format(
+                      mode, sent / elapsed, stats['requests'],
+                      stats['bytes_in'] / 1e6, stats['bytes_out'] / 1e6,
+                      stored, sent, len(errors)
+                  ))
+            if use_known_ids:
+                print('        {}'.format(loader.known_ids.info()))
+
+
+# An Elasticsearch to ingest into for 'signatures'; skipped if unreachable.
+SIGNATURE_BENCH_HOSTS = ['localhost:9200']
+SIGNATURE_BENCH_HITS = 100
+
+
+def bench_signature_storage(images_dir):
+    """ Builds the record of every ad image in `images_dir` with list and
+    with packed signatures and compares their JSON size, build time and
+    the time to decode `SIGNATURE_BENCH_HITS` search hits. With an
+    Elasticsearch at `SIGNATURE_BENCH_HOSTS`, also bulk-ingests both into
+    scratch indices and compares ingest time and store size. """
+    import logging
+    import numpy
+    from elasticsearch import Elasticsearch
+    from elasticsearch.helpers import bulk
+    from data_access import AdES, ImageSignatureService, signature_to_array
+
+    service = ImageSignatureService()
+    signatures = []
+    for name in sorted(os.listdir(images_dir)):
+        with open(os.path.join(images_dir, name), 'rb') as file:
+            image_signature, _ = service.get_image_signature_from_bytes(
+                file.read()
+            )
+        if image_signature:
+            signatures.append((name, image_signature))
+    print('images: {} from {}'.format(len(signatures), images_dir))
+
+    logging.getLogger('elasticsearch').setLevel(logging.ERROR)
+    es = Elasticsearch(hosts=SIGNATURE_BENCH_HOSTS)
+    if not es.ping():
+        print('No Elasticsearch at {}, not ingesting'.format(
+            SIGNATURE_BENCH_HOSTS
+        ))
+        es = None
+
+    for label, compact in (('lists', False), ('packed', True)):
+        aes = AdES(es, index='bench_signatures_{}'.format(label))
+        aes.compact_signatures = compact
+
+        start = time.perf_counter()
+        records = [
+            aes.make_record_from_signature_base64(
+                image_signature, path=name, metadata={'sources': []}
+            )
+            for name, image_signature in signatures
+        ]
+        build = time.perf_counter() - start
+        size = sum(len(json.dumps(record)) for record in records)
+
+        hits = json.dumps({'hits': [
+            {'_source': {'signature': record['signature']}}
+            for record in records[:SIGNATURE_BENCH_HITS]
+        ]})
+        start = time.perf_counter()
+        numpy.stack([
+            signature_to_array(hit['_source']['signature'])
+            for hit in json.loads(hits)['hits']
+        ])
+        decode = time.perf_counter() - start
+        print('{:6}: {:8.0f} B/record, {:8.1f} us/record built, {:8.2f} ms '
+              'to decode {} hits'.format(
+                  label, size / len(records), build / len(records) * 1e6,
+                  decode * 1e3, SIGNATURE_BENCH_HITS
+              ))
+
+        if es is None:
+            continue
+        es.indices.delete(index=aes.index, ignore=404)
+        if compact:
+            aes.create_index()
+        else:
+            es.indices.create(index=aes.index)
+        start = time.perf_counter()
+        bulk(es, (
+            {'_index': aes.index, '_type': aes.doc_type, '_source': record}
+            for record in records
+        ))
+        es.indices.refresh(index=aes.index)
+        ingest = time.perf_counter() - start
+        es.indices.forcemerge(index=aes.index, max_num_segments=1)
+        store = es.indices.stats(index=aes.index, metric='store')[
+            '_all']['primaries']['store']['size_in_bytes']
+        print('        {:8.2f} s ingest, {:8.2f} MB store after merge'.format(
+            ingest, store / 1e6
+        ))
+        es.indices.delete(index=aes.index)
+
+
+BENCHMARKS = {
+    'check_if_ad': bench_check_if_ad,
+    'rule_engine': bench_rule_engine,
+    'classify_urls': bench_classify_urls,
+    'decode': bench_screenshot_decode,
+    'upsert': bench_upsert,
+    'signatures': bench_signature_storage,
+}
+
+
+def bench_resource_blocking(driver, site_urls, timings_path):
+    """ Loads each site with and without a default `ResourceBlockingProfile`
+    on a cold cache and appends `site, profile, s, bytes, blocked, blocked
+    ads` rows to `timings_path`. Only the DevTools patterns are compared;
+    the profile's Chrome switches need a browser started with them. """
+    profile = ResourceBlockingProfile()
+    print('Blocking {} patterns, spared ad hosts: {}'.format(
+        len(profile.patterns()), profile.spared_hosts or 'none'
+    ))
+    totals = {'off': [0.0, 0], 'on': [0.0, 0]}
+    with open(timings_path, 'a') as timings:
+        for site_url in site_urls:
+            for name in sorted(totals, reverse=True):
+                if name == 'on':
+                    profile.apply(driver)
+                else:
+                    ResourceBlockingProfile.remove(driver)
+                driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+                driver.get('about:blank')
+                drain_performance_log(driver)
+                network = NetworkActivity()
+                start = time.perf_counter()
+                driver.get(site_url)
+                wait_for_page_ready(driver, network=network)
+                elapsed = time.perf_counter() - start
+                ads = blocked_ads(network)
+                totals[name][0] += elapsed
+                totals[name][1] += network.bytes_received
+                timings.write('{}\t{}\t{:.4f}\t{}\t{}\t{}\n'.format(
+                    site_url, name, elapsed, network.bytes_received,
+                    len(network.blocked), len(ads)
+                ))
+                if ads:
+                    print('WARNING: blocked ad requests on', site_url, ads)
+    ResourceBlockingProfile.remove(driver)
+
+    for name in sorted(totals, reverse=True):
+        elapsed, num_bytes = totals[name]
+        print('{:3}: {:8.4f} s/site, {:12.0f} bytes/site'.format(
+            name, elapsed / len(site_urls) if site_urls else 0.0,
+            num_bytes / len(site_urls) if site_urls else 0.0
+        ))
+
+
+ASYNC_BENCH_SESSIONS = 8
+
+
+def _visit_and_screenshot(driver, site_urls):
+    num_bytes = 0
+    for site_url in site_urls:
+        driver.get(site_url)
+        driver.execute_script('return document.readyState')
+        num_bytes += len(driver.get_screenshot_as_png())
+    return num_bytes
+
+
+async def _visit_and_screenshot_async(chromedriver, options, site_urls):
+    session = await chromedriver.new_session(options)
+    try:
+        num_bytes = 0
+        for site_url in site_urls:
+            await session.get(site_url)
+            await session.execute_script('return document.readyState')
+            num_bytes += len(await session.get_screenshot_as_png())
+        return num_bytes
+    finally:
+        await session.quit()
+
+
+def bench_async_sessions(driver, site_urls, timings_path):
+    """ Visits and screenshots every site in `ASYNC_BENCH_SESSIONS` browsers
+    at once, first with one selenium driver per thread, then with
+    `async_driver` sessions on one event loop. Appends `mode, sessions, s,
+    peak Python threads, screenshot bytes` rows to `timings_path`. The
+    given driver is not used. """
+    from selenium import webdriver
+    from google_login import chrome_options
+
+    def threaded_session():
+        session = webdriver.Chrome(options=chrome_options)
+        try:
+            return _visit_and_screenshot(session, site_urls)
+        finally:
+            session.quit()
+
+    results = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=ASYNC_BENCH_SESSIONS) as executor:
+        futures = [
+            executor.submit(threaded_session)
+            for _ in range(ASYNC_BENCH_SESSIONS)
+        ]
+        threads = threading.active_count()
+        num_bytes = sum(future.result() for future in futures)
+    results['threads'] = (time.perf_counter() - start, threads, num_bytes)
+
+    async def run_async():
+        async with AsyncChromeDriver() as chromedriver:
+            counts = await asyncio.gather(*(
+                _visit_and_screenshot_async(
+                    chromedriver, chrome_options, site_urls
+                )
+                for _ in range(ASYNC_BENCH_SESSIONS)
+            ))
+            return threading.active_count(), sum(counts)
+
+    start = time.perf_counter()
+    threads, num_bytes = asyncio.run(run_async())
+    results['asyncio'] = (time.perf_counter() - start, threads, num_bytes)
+
+    with open(timings_path, 'a') as timings:
+        for name, (elapsed, threads, num_bytes) in sorted(results.items()):
+            timings.write('{}\t{}\t{:.4f}\t{}\t{}\n'.format(
+                name, ASYNC_BENCH_SESSIONS, elapsed, threads, num_bytes
+            ))
+            print('{:8}: {:8.2f} s, {:6.2f} pages/s, {} Python threads'.format(
+                name, elapsed,
+                ASYNC_BENCH_SESSIONS * len(site_urls) / elapsed, threads
+            ))
+
+
+# These drive a real browser over `main.SITES`.
+BROWSER_BENCHMARKS = {
+    'record': record_url_corpus,
+    'harvest': bench_link_harvest,
+    'detection': bench_ad_detection,
+    'capture': bench_ad_capture,
+    'blocking': bench_resource_blocking,
+    'async': bench_async_sessions,
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="HackDay ad crawler benchmarks")
+    parser.add_argument(
+        "benchmark", choices=sorted(BENCHMARKS) + sorted(BROWSER_BENCHMARKS)
+    )
+    parser.add_argument(
+        "corpus", type=str,
+        help="file with one recorded URL per line, a recorded full-page PNG "
+             "for 'decode', a directory of ad images for 'upsert' and "
+             "'signatures', or the output file for browser benchmarks"
+    )
+    parser.add_argument(
+        "--fixtures", type=str, default=None,
+        help="serve this directory on localhost and visit its .html files "
+             "instead of main.SITES, e.g. fixtures/ (ad and non-ad iframes)"
+    )
+    par_args = parser.parse_args()
+
+    if par_args.benchmark in BROWSER_BENCHMARKS:
+        from selenium import webdriver
+        from google_login import chrome_options
+        from main import SITES
+
+        driver = webdriver.Chrome(options=chrome_options)
+        try:
+            if par_args.fixtures:
+                with serve_fixtures(par_args.fixtures) as fixture_urls:
+                    BROWSER_BENCHMARKS[par_args.benchmark](
+                        driver, fixture_urls, par_args.corpus
+                    )
+            else:
+                BROWSER_BENCHMARKS[par_args.benchmark](
+                    driver, SITES, par_args.corpus
+                )
+        finally:
+            driver.quit()
+
+    else:
+        BENCHMARKS[par_args.benchmark](par_args.corpus)
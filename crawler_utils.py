@@ -7,10 +7,17 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.keys import Keys
 from time import sleep
 import sys, argparse, os
+import json
+import math
+import random
 import string
 import time
+from collections import namedtuple
+from urllib.parse import urlparse
 from contextlib import contextmanager, ContextDecorator
 
+from waits import WAIT_BUDGET, WaitBudget, explicit_wait
+
 mine = os.path.abspath(os.path.dirname(sys.argv[0]))
 
 
@@ -19,8 +26,12 @@ class Browser:
 
     **Constructor**
 
-    :__init__(showWindow = True):
+    :__init__(showWindow = True, blocking_profile = None, in_page_search = False):
         The constructor takes showWindow flag as argument which Defaults to False. If it is set to true , all browser happen without showing up any GUI window .
+        blocking_profile is an optional resource_blocking.ResourceBlockingProfile ; the resources it names are never downloaded by the browser .
+        If in_page_search is True , elements are searched and ranked by one injected script ( see element_search_plan ) , so find_elements , exists , click and type each take a single round trip to the browser . click and type then fire DOM events from the page instead of native input , so typed special keys are not pressed .
+        If command_stats is True , every WebDriver command is timed into self.stats ( a CommandStats ) ; otherwise the driver is left untouched .
+        locator_cache is an optional LocatorCache ; the elements that won a search are remembered by page and search parameters and looked up directly next time . With in_page_search , click and type already take one round trip and do not use it .
 
 
     Object attributes:  Key , errors
@@ -33,13 +44,22 @@ class Browser:
 
     """
 
-    def __init__(self, showWindow=True):
+    def __init__(
+        self,
+        showWindow=True,
+        blocking_profile=None,
+        in_page_search=False,
+        locator_cache=None,
+        command_stats=False,
+    ):
         options = webdriver.ChromeOptions()
         options.add_argument("--disable-dev-shm-usage")
         options.add_argument("--no-sandbox")
 
         if not showWindow:
             options.set_headless(headless=True)
+        if blocking_profile is not None:
+            blocking_profile.add_to_options(options)
 
         if sys.platform == "linux" or sys.platform == "linux2":
             driverfilename = "/home/silas/chromedriver"
@@ -52,6 +72,15 @@ class Browser:
         self.driver = webdriver.Chrome(
             executable_path=driverpath, chrome_options=options
         )
+        self.blocking_profile = blocking_profile
+        self.in_page_search = in_page_search
+        self.locator_cache = locator_cache
+        self._locator_cache_key = None
+        self.stats = CommandStats()
+        if command_stats:
+            self.stats.instrument(self.driver)
+        if blocking_profile is not None:
+            blocking_profile.apply(self.driver)
         self.Key = Keys
         self.errors = list()
         [
@@ -92,6 +121,8 @@ class Browser:
         ]
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.locator_cache is not None:
+            self.locator_cache.save()
         if self.driver:
             self.driver.close()
 
@@ -109,10 +140,14 @@ class Browser:
 
     def close_browser(self):
         """CLose browser and kill child processes"""
+        if self.locator_cache is not None:
+            self.locator_cache.save()
         return self.driver.quit()
 
     def close_browser(self):
         """CLose browser and kill child processes"""
+        if self.locator_cache is not None:
+            self.locator_cache.save()
         return self.driver.quit()
 
     def get_application_cache(self):
@@ -218,28 +253,93 @@ class Browser:
     ):
         """Returns a list of elements that best fit the given parameters"""
 
-        self.element_to_score = OrderedDict()
-        self.element_to_score_id_set = set()
         if tag == "link":
             tag = "a"
 
+        # css_selector and xpath searches are already concrete selectors
+        if self.locator_cache is None or css_selector or xpath:
+            return self.__search(
+                text, tag, classname, id, number, css_selector, xpath, loose_match
+            )
+
+        cache_key = self.locator_cache.key(
+            self.driver.current_url, text, tag, classname, id
+        )
+        elements = self.__cached_elements(cache_key, tag)
+        if elements:
+            self._max_score_elements_ = elements
+            return elements
+
+        elements = self.__search(
+            text, tag, classname, id, number, css_selector, xpath, loose_match
+        )
+        if elements:
+            self.locator_cache.store(
+                cache_key, self.driver.execute_script(ELEMENT_XPATH_SCRIPT, elements)
+            )
+        return elements
+
+    def __cached_elements(self, cache_key, tag):
+        """Returns the elements found by the selectors cached for cache_key, or
+        None if there are none or they no longer find usable elements with
+        the fingerprints they were cached with"""
+
+        selectors = self.locator_cache.get(cache_key)
+        if not selectors:
+            return None
+
+        elements = []
+        fingerprints = []
+        try:
+            for selector, fingerprint in selectors:
+                found = self.driver.find_elements_by_xpath(selector)
+                if len(found) != 1 or not is_candidate(found[0], tag):
+                    break
+                elements.append(found[0])
+                fingerprints.append(fingerprint)
+            # The same position may now hold another element
+            if fingerprints != self.driver.execute_script(
+                ELEMENT_FINGERPRINT_SCRIPT, elements
+            ):
+                elements = []
+        except (exceptions.WebDriverException, TypeError, ValueError):
+            # TypeError and ValueError : an entry in an older format
+            elements = []
+
+        if not elements or len(elements) != len(selectors):
+            self.locator_cache.forget(cache_key)
+            return None
+        self._locator_cache_key = cache_key
+        return elements
+
+    def __forget_cached_locator(self):
+        """Drops the cache entry the last elements were found by, if any ;
+        call it when one of them went stale"""
+        if self._locator_cache_key:
+            self.locator_cache.forget(self._locator_cache_key)
+            self._locator_cache_key = None
+
+    def __search(
+        self, text, tag, classname, id, number, css_selector, xpath, loose_match
+    ):
+        """Runs the search cascade of __find_element"""
+
+        self._locator_cache_key = None
+        plan = element_search_plan(
+            text, tag, classname, id, css_selector, xpath, loose_match
+        )
+        if self.in_page_search:
+            return self.__search_in_page(plan, tag, classname, id)["elements"]
+
+        self.element_to_score = OrderedDict()
+        self.element_to_score_id_set = set()
+
         def add_to_init_text_matches_score(text_matches_elements, score):
             """Extends a dictionary and maps it with the text_matched_element with the score"""
 
             for element in text_matches_elements:
                 try:
-                    if (
-                        (not element.is_displayed())
-                        or (
-                            not element.is_enabled()
-                            and tag in ["input", "button", "a", "textarea"]
-                        )
-                        or (element.get_attribute("hidden") == "true")
-                        or (
-                            element.tag_name == "input"
-                            and element.get_attribute("type") == "hidden"
-                        )
-                    ):
+                    if not is_candidate(element, tag):
                         continue
 
                     # accessing id or class attribute of stale element("like that input tag which in is google.com page ") raises this exception
@@ -264,7 +364,7 @@ class Browser:
                 self.driver.find_elements_by_xpath(xpath), score
             )
 
-        def find_input_element_for_label(elementlist, score):
+        def find_input_element_for_label(elementlist, score, sibling_query):
             """This method finds the input tag elements by taking in the label elements and assigns the score argument to the new found input elements and puts them in the  elemenet to score mapping """
 
             for element in elementlist:
@@ -278,12 +378,7 @@ class Browser:
                     )
 
                     add_to_init_text_matches_score(
-                        element.find_elements_by_xpath(
-                            "../input[contains(translate(@id , '{}' ,'{}' ) , '{}')]".format(
-                                text.upper(), text.lower(), text.lower()
-                            )
-                        ),
-                        score - 5,
+                        element.find_elements_by_xpath(sibling_query), score - 5,
                     )
 
                     add_to_init_text_matches_score(
@@ -302,175 +397,24 @@ class Browser:
                 except exceptions.NoSuchElementException as E:
                     self.__set_error(E, element)
 
-        def handle_input_tag():
-            if text:
-                for test_attr in ["@value", "@placeholder", "name", "@aria-label"]:
-                    element_fetch_helper(
-                        ("//body//input[{}='{}']".format(test_attr, text)), score=45
-                    )
-                    element_fetch_helper(
-                        ("//body//input[contains( {} , '{}')]".format(test_attr, text)),
-                        score=37,
+        for only_if_nothing_found, steps in plan:
+            if only_if_nothing_found and len(self.element_to_score.keys()):
+                continue
+
+            for step in steps:
+                if step["by"] == "label":
+                    find_input_element_for_label(
+                        self.driver.find_elements_by_xpath(step["query"]),
+                        step["score"],
+                        step["sibling_query"],
                     )
-                    element_fetch_helper(
-                        (
-                            "//body//input[contains(translate( {} , '{}' , '{}' ) , '{}')]".format(
-                                test_attr, text.upper(), text.lower(), text.lower()
-                            )
+                else:
+                    add_to_init_text_matches_score(
+                        getattr(self.driver, "find_elements_by_" + step["by"])(
+                            step["query"]
                         ),
-                        score=33,
-                    )
-
-                find_input_element_for_label(
-                    self.driver.find_elements_by_xpath(
-                        "//body//label[text()='{}']".format(text)
-                    ),
-                    score=45,
-                )
-
-                find_input_element_for_label(
-                    self.driver.find_elements_by_xpath(
-                        "//body//label[contains( text() , '{}')]".format(text)
-                    ),
-                    score=37,
-                )
-
-                find_input_element_for_label(
-                    self.driver.find_elements_by_xpath(
-                        "//body//label[contains(translate( text() , '{}' , '{}' ) , '{}')]".format(
-                            text.upper(), text.lower(), text.lower()
-                        )
-                    ),
-                    score=33,
-                )
-
-            else:
-                element_fetch_helper("//body//{}".format(tag), score=40)
-
-        def handle_button_or_link_tag(tagvar):
-            if text:
-                element_fetch_helper(
-                    ("//body//{}[text()='{}']".format(tagvar, text)), score=45
-                )
-                element_fetch_helper(
-                    ("//body//{}//*[text()='{}']".format(tagvar, text)), score=45
-                )
-
-                add_to_init_text_matches_score(
-                    self.driver.find_elements_by_link_text("{}".format(text)), score=43
-                )
-
-                element_fetch_helper(
-                    ("//body//{}[contains(text() , '{}')]".format(tagvar, text)),
-                    score=37,
-                )
-                element_fetch_helper(
-                    ("//body//{}//*[contains(text() , '{}')]".format(tagvar, text)),
-                    score=37,
-                )
-
-                element_fetch_helper(
-                    (
-                        "//body//{}[contains(translate(text() , '{}' , '{}' ) , '{}')]".format(
-                            tagvar, text.upper(), text.lower(), text.lower()
-                        )
-                    ),
-                    score=33,
-                )
-                element_fetch_helper(
-                    (
-                        "//body//{}//*[contains(translate(text() , '{}' , '{}' ) , '{}')]".format(
-                            tagvar, text.upper(), text.lower(), text.lower()
-                        )
-                    ),
-                    score=33,
-                )
-
-            else:
-                element_fetch_helper(("//body//{}".format(tagvar)), score=40)
-
-        def handle_loose_check():
-            """This method must only be used iff no element based on the given text input is found ! """
-            if text:
-                element_fetch_helper("//body//*[@value='{}']".format(text), score=30)
-                element_fetch_helper("//body//*[text()='{}']".format(text), score=30)
-
-                element_fetch_helper(
-                    ("//body//*[contains(text() , '{}')]".format(text)), score=27
-                )
-
-                element_fetch_helper(
-                    (
-                        "//body//*[contains(translate(text() , '{}' , '{}' ) , '{}' )]".format(
-                            text.upper(), text.lower(), text.lower()
-                        )
-                    ),
-                    score=25,
-                )
-
-        if css_selector:
-            add_to_init_text_matches_score(
-                self.driver.find_elements_by_css_selector(css_selector), 80
-            )
-
-        if xpath:
-            add_to_init_text_matches_score(
-                self.driver.find_elements_by_xpath(xpath), 100
-            )
-
-        if not text and tag:
-            element_fetch_helper(("//body//{}".format(tag)), score=50)
-
-        elif tag:
-            element_fetch_helper(
-                ("//body//{}[@value='{}']".format(tag, text)), score=50
-            )
-            element_fetch_helper(
-                ("//body//{}[text()='{}']".format(tag, text)), score=50
-            )
-            element_fetch_helper(
-                ("//body//{}[contains(text() , '{}') ]".format(tag, text)), score=49
-            )
-            element_fetch_helper(
-                (
-                    "//body//{0}[contains(translate(text()  ,'{1}', '{2}') , '{2}') ]".format(
-                        tag, text.upper(), text.lower()
+                        step["score"],
                     )
-                ),
-                score=48,
-            )
-
-        if text.lower() in "your password":
-            element_fetch_helper(
-                "//body//input[contains(@name , '{}') ]".format("password"), score=47
-            )
-
-        if text.lower() in ["username", "email", "login"] and tag == "input":
-            element_fetch_helper(
-                """//body//input[contains(translate(@name , 'USERNAME' , 'username' )  , 'username') or contains(translate(@name ,'EMAIL' , 'email' ) , 'email') or contains(translate(@name , 'LOGIN' , 'login'  ) , 'login' ) or contains(translate(@type , 'EMAIL' , 'email') , 'email')] """,
-                53,
-            )
-
-        if tag == "input":
-            handle_input_tag()
-
-        if tag == "button":
-            handle_button_or_link_tag(tag)
-
-            if len(self.element_to_score.keys()) == 0:
-                handle_input_tag()
-            if len(self.element_to_score.keys()) == 0:
-                handle_button_or_link_tag("a")
-
-        if id:
-            add_to_init_text_matches_score(self.driver.find_elements_by_id(id), 100)
-        if classname:
-            add_to_init_text_matches_score(
-                self.driver.find_elements_by_class_name(classname), 50
-            )
-
-        if not len(self.element_to_score.keys()) and loose_match:
-            handle_loose_check()
 
         if not len(self.element_to_score.keys()):
             self.__set_error(
@@ -520,6 +464,30 @@ class Browser:
 
         return self._max_score_elements_
 
+    def __search_in_page(
+        self, plan, tag, classname, id, action="find", number=1, multiple=False,
+        keys="", clear=True,
+    ):
+        """Runs an element_search_plan, the ranking and the optional click or
+        type action in a single execute_script call"""
+
+        result = self.driver.execute_script(
+            in_page_search_script(),
+            plan, tag, classname, id, action, number, multiple, keys, clear,
+        )
+        for error in result["errors"]:
+            self.__set_error(error["message"], error["element"])
+
+        if not result["elements"]:
+            self.__set_error(
+                "Element not found ! ",
+                message="There is no element that matches your search criteria.",
+            )
+
+        self._max_score_elements_ = result["elements"]
+        self._max_score_ = result["score"]
+        return result
+
     def __set_error(self, Exceptionerror, element=None, message=""):
         """Set the error in case of any exception occured whenever performing any action like click or type """
         self.errors.append(
@@ -549,11 +517,7 @@ class Browser:
         """Switch to the tab corresponding to the number argument. The tabs are numbered in the order that they are opened by the web driver.
 So changing the order of the tabs in the browser won't change the tab numbers.
         """
-        assert (
-            number <= len(self.driver.window_handles) and number > 0
-        ), "Tab number must be less than or equal to the total number of tabs"
-
-        self.driver.switch_to_window(self.driver.window_handles[number - 1])
+        switch_to_tab(self.driver, number)
 
     def go_back(self):
         """Go back to the previous URL.
@@ -626,6 +590,15 @@ If the url doesn't contain the protocol of the url  , then by default https is c
             ActionChains(self.driver).click().perform()
             return
 
+        if self.in_page_search:
+            if tag == "link":
+                tag = "a"
+            plan = element_search_plan(
+                text, tag, classname, id, css_selector, xpath, loose_match
+            )
+            self.__search_in_page(plan, tag, classname, id, "click", number, multiple)
+            return
+
         maxElements = self.__find_element(
             text, tag, classname, id, number, css_selector, xpath, loose_match
         )
@@ -642,6 +615,8 @@ If the url doesn't contain the protocol of the url  , then by default https is c
                     temp_element_index_ += 1
 
             except Exception as E:
+                if isinstance(E, exceptions.StaleElementReferenceException):
+                    self.__forget_cached_locator()
                 self.__set_error(
                     E,
                     element,
@@ -789,6 +764,17 @@ If the url doesn't contain the protocol of the url  , then by default https is c
             ActionChains(self.driver).send_keys(text).perform()
             return
 
+        if self.in_page_search:
+            if tag == "link":
+                tag = "a"
+            plan = element_search_plan(
+                into, tag, classname, id, css_selector, xpath, loose_match
+            )
+            self.__search_in_page(
+                plan, tag, classname, id, "type", number, multiple, text, clear
+            )
+            return
+
         maxElements = self.__find_element(
             into, tag, classname, id, number, css_selector, xpath, loose_match
         )
@@ -809,6 +795,8 @@ If the url doesn't contain the protocol of the url  , then by default https is c
                 temp_element_index_ += 1
 
             except exceptions.WebDriverException as E:
+                if isinstance(E, exceptions.StaleElementReferenceException):
+                    self.__forget_cached_locator()
                 self.__set_error(
                     E,
                     element,
@@ -829,7 +817,10 @@ If the url doesn't contain the protocol of the url  , then by default https is c
             sleep(1)
         return
 
-    def click_element(self, element, tryNum=0):
+    def click_element(self, element, tryNum=0, budget=None):
+        if budget is None:
+            budget = WaitBudget()
+
         try:
             element.click()
         except Exception:
@@ -855,13 +846,19 @@ If the url doesn't contain the protocol of the url  , then by default https is c
                     + "')[0].click()"
                 )
                 return
-            sleep_actual(1)
+            try:
+                explicit_wait(
+                    self.driver, "VOE", [element], notify=False, budget=budget
+                )
+            except exceptions.WebDriverException:
+                pass
             tryNum += 1
-            click_element(self.driver, element, tryNum)
+            self.click_element(element, tryNum, budget)
 
-    def web_address_navigator(self, link):
+    def web_address_navigator(self, link, timeout=WAIT_BUDGET):
         """Checks and compares current URL of web page and the URL to be
-        navigated and if it is different, it does navigate"""
+        navigated and if it is different, it does navigate and waits up to
+        timeout seconds for the page to load"""
         current_url = get_current_url(self.driver)
         total_timeouts = 0
         page_type = None  # file or directory
@@ -881,7 +878,13 @@ If the url doesn't contain the protocol of the url  , then by default https is c
                     self.driver.get(link)
                     # update server calls
                     update_activity(self.driver, state=None)
-                    sleep(2)
+                    explicit_wait(
+                        self.driver,
+                        "PFL",
+                        [],
+                        notify=False,
+                        budget=WaitBudget(timeout),
+                    )
                     break
 
                 except TimeoutException as exc:
@@ -898,6 +901,605 @@ If the url doesn't contain the protocol of the url  , then by default https is c
                     sleep(2)
 
 
+def element_search_plan(text, tag, classname, id, css_selector, xpath, loose_match):
+    """Returns the queries Browser.__find_element runs, in order, as a list of
+    (only_if_nothing_found_yet, steps) groups. Each step is a dict with the
+    selenium locator strategy in "by" (or "label" for the inputs of matching
+    labels), its "query" and the "score" given to the elements it finds.
+    The same plan is run by selenium calls or inside the page ;
+    search_plan_check.py checks it against the cascade it replaced."""
+
+    def step(by, query, score, **extra):
+        extra.update(by=by, query=query, score=score)
+        return extra
+
+    def input_steps(tag):
+        if not text:
+            return [step("xpath", "//body//{}".format(tag), 40)]
+
+        steps = []
+        for test_attr in ["@value", "@placeholder", "name", "@aria-label"]:
+            steps.append(
+                step("xpath", "//body//input[{}='{}']".format(test_attr, text), 45)
+            )
+            steps.append(
+                step(
+                    "xpath",
+                    "//body//input[contains( {} , '{}')]".format(test_attr, text),
+                    37,
+                )
+            )
+            steps.append(
+                step(
+                    "xpath",
+                    "//body//input[contains(translate( {} , '{}' , '{}' ) , '{}')]".format(
+                        test_attr, text.upper(), text.lower(), text.lower()
+                    ),
+                    33,
+                )
+            )
+
+        sibling_query = "../input[contains(translate(@id , '{}' ,'{}' ) , '{}')]".format(
+            text.upper(), text.lower(), text.lower()
+        )
+        for query, score in [
+            ("//body//label[text()='{}']".format(text), 45),
+            ("//body//label[contains( text() , '{}')]".format(text), 37),
+            (
+                "//body//label[contains(translate( text() , '{}' , '{}' ) , '{}')]".format(
+                    text.upper(), text.lower(), text.lower()
+                ),
+                33,
+            ),
+        ]:
+            steps.append(step("label", query, score, sibling_query=sibling_query))
+        return steps
+
+    def button_or_link_steps(tagvar):
+        if not text:
+            return [step("xpath", "//body//{}".format(tagvar), 40)]
+
+        return [
+            step("xpath", "//body//{}[text()='{}']".format(tagvar, text), 45),
+            step("xpath", "//body//{}//*[text()='{}']".format(tagvar, text), 45),
+            step("link_text", "{}".format(text), 43),
+            step("xpath", "//body//{}[contains(text() , '{}')]".format(tagvar, text), 37),
+            step(
+                "xpath", "//body//{}//*[contains(text() , '{}')]".format(tagvar, text), 37
+            ),
+            step(
+                "xpath",
+                "//body//{}[contains(translate(text() , '{}' , '{}' ) , '{}')]".format(
+                    tagvar, text.upper(), text.lower(), text.lower()
+                ),
+                33,
+            ),
+            step(
+                "xpath",
+                "//body//{}//*[contains(translate(text() , '{}' , '{}' ) , '{}')]".format(
+                    tagvar, text.upper(), text.lower(), text.lower()
+                ),
+                33,
+            ),
+        ]
+
+    steps = []
+    if css_selector:
+        steps.append(step("css_selector", css_selector, 80))
+
+    if xpath:
+        steps.append(step("xpath", xpath, 100))
+
+    if not text and tag:
+        steps.append(step("xpath", "//body//{}".format(tag), 50))
+
+    elif tag:
+        steps.append(step("xpath", "//body//{}[@value='{}']".format(tag, text), 50))
+        steps.append(step("xpath", "//body//{}[text()='{}']".format(tag, text), 50))
+        steps.append(
+            step("xpath", "//body//{}[contains(text() , '{}') ]".format(tag, text), 49)
+        )
+        steps.append(
+            step(
+                "xpath",
+                "//body//{0}[contains(translate(text()  ,'{1}', '{2}') , '{2}') ]".format(
+                    tag, text.upper(), text.lower()
+                ),
+                48,
+            )
+        )
+
+    if text.lower() in "your password":
+        steps.append(
+            step(
+                "xpath", "//body//input[contains(@name , '{}') ]".format("password"), 47
+            )
+        )
+
+    if text.lower() in ["username", "email", "login"] and tag == "input":
+        steps.append(
+            step(
+                "xpath",
+                """//body//input[contains(translate(@name , 'USERNAME' , 'username' )  , 'username') or contains(translate(@name ,'EMAIL' , 'email' ) , 'email') or contains(translate(@name , 'LOGIN' , 'login'  ) , 'login' ) or contains(translate(@type , 'EMAIL' , 'email') , 'email')] """,
+                53,
+            )
+        )
+
+    if tag == "input":
+        steps.extend(input_steps(tag))
+
+    plan = [(False, steps)]
+    if tag == "button":
+        steps.extend(button_or_link_steps(tag))
+        plan.append((True, input_steps(tag)))
+        plan.append((True, button_or_link_steps("a")))
+
+    steps = []
+    if id:
+        steps.append(step("id", id, 100))
+    if classname:
+        steps.append(step("class_name", classname, 50))
+    plan.append((False, steps))
+
+    if loose_match and text:
+        plan.append(
+            (
+                True,
+                [
+                    step("xpath", "//body//*[@value='{}']".format(text), 30),
+                    step("xpath", "//body//*[text()='{}']".format(text), 30),
+                    step("xpath", "//body//*[contains(text() , '{}')]".format(text), 27),
+                    step(
+                        "xpath",
+                        "//body//*[contains(translate(text() , '{}' , '{}' ) , '{}' )]".format(
+                            text.upper(), text.lower(), text.lower()
+                        ),
+                        25,
+                    ),
+                ]
+            )
+        )
+    return plan
+
+
+def is_candidate(element, tag):
+    """Whether a found element can be the result of a search for tag : it must
+    be visible , enabled for form and link tags , and not a hidden input"""
+    return not (
+        (not element.is_displayed())
+        or (
+            not element.is_enabled()
+            and tag in ["input", "button", "a", "textarea"]
+        )
+        or (element.get_attribute("hidden") == "true")
+        or (
+            element.tag_name == "input"
+            and element.get_attribute("type") == "hidden"
+        )
+    )
+
+
+# What a cached locator must still find: tag, id, class and the start of the
+# text or, for form fields, of the value, placeholder or label attributes.
+ELEMENT_FINGERPRINT_FUNCTION = """
+function fingerprintOf(element) {
+  var text = element.textContent || element.value ||
+      element.getAttribute("placeholder") ||
+      element.getAttribute("aria-label") || element.getAttribute("name") || "";
+  return [element.localName, element.id, element.getAttribute("class") || "",
+          text.trim().slice(0, 200)];
+}
+"""
+
+ELEMENT_FINGERPRINT_SCRIPT = ELEMENT_FINGERPRINT_FUNCTION + """
+return arguments[0].map(fingerprintOf);
+"""
+
+# Returns, for each element passed, an XPath that finds only that element (by
+# its id when the id is unique, else by its position from the root) and its
+# fingerprint.
+ELEMENT_XPATH_SCRIPT = ELEMENT_FINGERPRINT_FUNCTION + """
+function xpathOf(element) {
+  if (element.id && element.id.indexOf("'") < 0 &&
+      document.querySelectorAll('[id="' + element.id + '"]').length === 1) {
+    return "//*[@id='" + element.id + "']";
+  }
+  var parts = [];
+  for (; element && element.nodeType === 1; element = element.parentNode) {
+    var position = 1;
+    for (var sibling = element.previousElementSibling; sibling;
+         sibling = sibling.previousElementSibling) {
+      if (sibling.localName === element.localName) position++;
+    }
+    parts.unshift("*[local-name()='" + element.localName + "'][" + position + "]");
+  }
+  return "/" + parts.join("/");
+}
+return arguments[0].map(function (element) {
+  return [xpathOf(element), fingerprintOf(element)];
+});
+"""
+
+LOCATOR_CACHE_FILE = "locators.cache"
+# Changed entries kept in memory before the cache file is rewritten
+LOCATOR_CACHE_SAVE_EVERY = 50
+
+LocatorCacheInfo = namedtuple(
+    "LocatorCacheInfo", ["hits", "misses", "stale", "hit_rate", "size"]
+)
+
+
+def url_pattern(url):
+    """The host and path of url , with runs of digits replaced by * so that
+    pages with the same layout share cached locators"""
+    parsed = urlparse(url)
+    return parsed.netloc + re.sub(r"\d+", "*", parsed.path)
+
+
+class LocatorCache:
+    """
+    Remembers , for each ( url pattern , text , tag , classname , id ) search ,
+    the XPaths and fingerprints of the elements that won it last time , on
+    disk as JSON . A Browser tries them before running the search cascade and
+    forgets them once they stop finding usable elements with the same
+    fingerprints ( stale ) . The file is rewritten every save_every changes
+    and by save , which Browser.close_browser calls .
+    """
+
+    def __init__(self, path=LOCATOR_CACHE_FILE, save_every=LOCATOR_CACHE_SAVE_EVERY):
+        self.path = path
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._unsaved = 0
+        try:
+            with open(path, "r") as file:
+                self._locators = json.load(file)
+        except (OSError, ValueError):
+            self._locators = {}
+
+    @staticmethod
+    def key(url, text, tag, classname, id):
+        return json.dumps([url_pattern(url), text, tag, classname, id])
+
+    def get(self, key):
+        selectors = self._locators.get(key)
+        if selectors:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return selectors
+
+    def store(self, key, selectors):
+        """selectors is a list of [ xpath , fingerprint ] pairs"""
+        self._locators[key] = selectors
+        self._changed()
+
+    def forget(self, key):
+        """Drops a stale entry ; its lookup is counted as stale , not a hit"""
+        if self._locators.pop(key, None) is not None:
+            self.hits -= 1
+            self.stale += 1
+            self._changed()
+
+    def _changed(self):
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def save(self):
+        if not self._unsaved:
+            return
+        self._unsaved = 0
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as file:
+                json.dump(self._locators, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print("Exception writing locator cache:", e)
+
+    def info(self):
+        lookups = self.hits + self.misses + self.stale
+        return LocatorCacheInfo(
+            self.hits,
+            self.misses,
+            self.stale,
+            self.hits / lookups if lookups else 0.0,
+            len(self._locators),
+        )
+
+
+# Latency samples kept per command; past this, samples are replaced at random
+# so the percentiles stay representative.
+COMMAND_STATS_MAX_SAMPLES = 10000
+
+
+class CommandStats:
+    """
+    Counts , errors and latency percentiles of each WebDriver command ( as
+    named by selenium's Command , e.g. "get" or "findElements" ) .
+    instrument wraps the driver's execute method , which every command goes
+    through ; a driver that is not instrumented pays nothing .
+    """
+
+    def __init__(self, max_samples=COMMAND_STATS_MAX_SAMPLES):
+        self.max_samples = max_samples
+        self.enabled = False
+        self._commands = OrderedDict()
+
+    def instrument(self, driver):
+        """Times every command of driver from now on"""
+        execute = driver.execute
+
+        def timed_execute(driver_command, params=None):
+            start = time.perf_counter()
+            try:
+                response = execute(driver_command, params)
+            except Exception:
+                self.record(driver_command, time.perf_counter() - start, True)
+                raise
+            self.record(driver_command, time.perf_counter() - start)
+            return response
+
+        driver.execute = timed_execute
+        self.enabled = True
+
+    def record(self, command, seconds, error=False):
+        stats = self._commands.get(command)
+        if stats is None:
+            stats = self._commands[command] = {
+                "count": 0,
+                "errors": 0,
+                "total": 0.0,
+                "samples": [],
+            }
+        stats["count"] += 1
+        stats["errors"] += error
+        stats["total"] += seconds
+        if len(stats["samples"]) < self.max_samples:
+            stats["samples"].append(seconds)
+        else:
+            index = random.randrange(stats["count"])
+            if index < self.max_samples:
+                stats["samples"][index] = seconds
+
+    def summary(self):
+        """command -> count , errors , total seconds and p50 / p95 / p99"""
+        summary = OrderedDict()
+        for command, stats in self._commands.items():
+            samples = sorted(stats["samples"])
+            summary[command] = {
+                "count": stats["count"],
+                "errors": stats["errors"],
+                "total": stats["total"],
+            }
+            for name, quantile in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                # nearest rank
+                rank = max(0, math.ceil(quantile * len(samples)) - 1)
+                summary[command][name] = samples[rank]
+        return summary
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix="webdriver_command"):
+        """The summary in the Prometheus text exposition format"""
+        summary = self.summary()
+        lines = [
+            "# HELP {}_seconds WebDriver command latency.".format(prefix),
+            "# TYPE {}_seconds summary".format(prefix),
+        ]
+        for command, stats in summary.items():
+            for name, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99")):
+                lines.append(
+                    '{}_seconds{{command="{}",quantile="{}"}} {}'.format(
+                        prefix, command, quantile, stats[name]
+                    )
+                )
+            lines.append(
+                '{}_seconds_sum{{command="{}"}} {}'.format(prefix, command, stats["total"])
+            )
+            lines.append(
+                '{}_seconds_count{{command="{}"}} {}'.format(
+                    prefix, command, stats["count"]
+                )
+            )
+        lines.append("# HELP {}_errors_total WebDriver command errors.".format(prefix))
+        lines.append("# TYPE {}_errors_total counter".format(prefix))
+        for command, stats in summary.items():
+            lines.append(
+                '{}_errors_total{{command="{}"}} {}'.format(prefix, command, stats["errors"])
+            )
+        return "\n".join(lines) + "\n"
+
+    def print_stats(self):
+        if not self.enabled:
+            print("WebDriver command stats are disabled")
+            return
+        print(
+            "{:28} {:>7} {:>6} {:>9} {:>9} {:>9}".format(
+                "command", "count", "errors", "p50 ms", "p95 ms", "p99 ms"
+            )
+        )
+        for command, stats in self.summary().items():
+            print(
+                "{:28} {:7} {:6} {:9.1f} {:9.1f} {:9.1f}".format(
+                    command,
+                    stats["count"],
+                    stats["errors"],
+                    stats["p50"] * 1000,
+                    stats["p95"] * 1000,
+                    stats["p99"] * 1000,
+                )
+            )
+
+    def clear(self):
+        self._commands.clear()
+
+
+# Runs an element_search_plan inside the page, ranks the elements like
+# Browser.__find_element and optionally clicks or types into the best ones.
+# isShown and getAttribute are selenium's own atoms (see in_page_search_script).
+IN_PAGE_SEARCH_SCRIPT = """
+var plan = arguments[0], tag = arguments[1], classname = arguments[2],
+    id = arguments[3], action = arguments[4], number = arguments[5],
+    multiple = arguments[6], keys = arguments[7], clear = arguments[8];
+var elements = [], scores = [], acted = [], errors = [];
+var checkEnabled = ["input", "button", "a", "textarea"].indexOf(tag) >= 0;
+
+function isEnabled(element) {
+  return !(element.matches && element.matches(":disabled"));
+}
+
+function add(found, score) {
+  for (var i = 0; i < found.length; i++) {
+    var element = found[i];
+    if (!isShown(element) || (checkEnabled && !isEnabled(element)) ||
+        getAttribute(element, "hidden") === "true" ||
+        (element.tagName.toLowerCase() === "input" &&
+         getAttribute(element, "type") === "hidden")) {
+      continue;
+    }
+    var index = elements.indexOf(element);
+    if (index >= 0) {
+      scores[index] = Math.max(scores[index], score);
+    } else {
+      elements.push(element);
+      scores.push(score);
+    }
+  }
+}
+
+function byXpath(query, context) {
+  var result = document.evaluate(
+    query, context || document, null,
+    XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+  var found = [];
+  for (var i = 0; i < result.snapshotLength; i++) {
+    if (result.snapshotItem(i).nodeType === 1) {
+      found.push(result.snapshotItem(i));
+    }
+  }
+  return found;
+}
+
+function find(by, query) {
+  if (by === "xpath") return byXpath(query);
+  if (by === "css_selector") return document.querySelectorAll(query);
+  if (by === "id") return document.querySelectorAll('[id="' + query + '"]');
+  if (by === "class_name") return document.querySelectorAll("." + query);
+  if (by === "link_text") {
+    return Array.prototype.filter.call(
+      document.getElementsByTagName("a"),
+      function (link) { return (link.innerText || "").trim() === query; });
+  }
+  throw new Error("Unknown locator strategy: " + by);
+}
+
+function addLabelInputs(step) {
+  var labels = byXpath(step.query);
+  for (var i = 0; i < labels.length; i++) {
+    var target = getAttribute(labels[i], "for");
+    if (target === null) target = "None";
+    add(byXpath("//body//input[@id='" + target + "']"), step.score);
+    add(byXpath(step.sibling_query, labels[i]), step.score - 5);
+    add(byXpath("/./preceding::input", labels[i]), step.score - 7);
+    add(byXpath("//body//input[@name='" + target + "']"), step.score - 6);
+    add(byXpath("../input", labels[i]), step.score - 10);
+  }
+}
+
+for (var g = 0; g < plan.length; g++) {
+  if (plan[g][0] && elements.length) continue;
+  for (var s = 0; s < plan[g][1].length; s++) {
+    var step = plan[g][1][s];
+    if (step.by === "label") {
+      addLabelInputs(step);
+    } else {
+      add(find(step.by, step.query), step.score);
+    }
+  }
+}
+if (!elements.length) return {elements: [], score: null, acted: [], errors: []};
+
+var lowerTag = tag.toLowerCase();
+for (var i = 0; i < elements.length; i++) {
+  var elementTag = elements[i].tagName.toLowerCase();
+  if (id && id === getAttribute(elements[i], "id")) scores[i] += 100;
+  if (classname && (getAttribute(elements[i], "class") || "").split(/\\s+/)
+      .indexOf(classname) >= 0) {
+    scores[i] += 50;
+  }
+  if ((["button", "link"].indexOf(lowerTag) >= 0 &&
+       ["button", "a"].indexOf(elementTag) >= 0) ||
+      (lowerTag === "input" && elementTag === "input")) {
+    scores[i] += 35;
+  }
+  if (["button", "input"].indexOf(tag) >= 0 &&
+      ["button", "a", "input"].indexOf(elementTag) >= 0) {
+    scores[i] += 30;
+  }
+}
+
+var best = Math.max.apply(null, scores);
+var bestElements = elements.filter(function (element, i) {
+  return scores[i] === best;
+});
+
+var position = 1;
+for (var i = 0; i < bestElements.length && action !== "find"; i++) {
+  var element = bestElements[i];
+  try {
+    if (action === "click") {
+      if (!isShown(element) || !isEnabled(element)) continue;
+      if (number === position || multiple) {
+        element.scrollIntoView({block: "center", inline: "center"});
+        element.click();
+        acted.push(element);
+        if (!multiple) break;
+      }
+    } else if (number === position || multiple) {
+      element.focus();
+      if ("value" in element) {
+        element.value = (clear ? "" : element.value) + keys;
+      } else {
+        element.textContent = (clear ? "" : element.textContent) + keys;
+      }
+      element.dispatchEvent(new Event("input", {bubbles: true}));
+      element.dispatchEvent(new Event("change", {bubbles: true}));
+      acted.push(element);
+      if (!multiple) break;
+    }
+    position++;
+  } catch (error) {
+    errors.push({element: element, message: String(error)});
+  }
+}
+return {elements: bestElements, score: best, acted: acted, errors: errors};
+"""
+
+_in_page_search_script = None
+
+
+def in_page_search_script():
+    """IN_PAGE_SEARCH_SCRIPT with selenium's isDisplayed and getAttribute
+    atoms, so the in-page checks match WebElement.is_displayed and
+    WebElement.get_attribute"""
+    global _in_page_search_script
+    if _in_page_search_script is None:
+        from selenium.webdriver.remote.webelement import (
+            getAttribute_js,
+            isDisplayed_js,
+        )
+
+        _in_page_search_script = "var isShown = {};\nvar getAttribute = {};\n{}".format(
+            isDisplayed_js, getAttribute_js, IN_PAGE_SEARCH_SCRIPT
+        )
+    return _in_page_search_script
+
+
 def retries(max_tries, delay=1, backoff=2, exceptions=(Exception,), hook=None):
     def dec(func):
         def f2(*args, **kwargs):
@@ -991,22 +1593,53 @@ def get_links(html, link_regex):
 
 
 @contextmanager
-def new_tab(browser):
+def new_tab(browser, timeout=WAIT_BUDGET):
     """ USE once a host tab must remain untouched and yet needs extra data-
     get from guest tab """
+    budget = WaitBudget(timeout)
+    windows = len(browser.window_handles)
     try:
         # add a guest tab
         browser.execute_script("window.open()")
-        sleep(1)
+        explicit_wait(browser, "NW", [windows + 1], notify=False, budget=budget)
         # switch to the guest tab
         browser.switch_to.window(browser.window_handles[1])
-        sleep(2)
         yield
 
     finally:
         # close the guest tab
         browser.execute_script("window.close()")
-        sleep(1)
+        explicit_wait(browser, "NW", [windows], notify=False, budget=budget)
         # return to the host tab
         browser.switch_to.window(browser.window_handles[0])
-        sleep(2)
+
+
+def open_tab(browser, url="", timeout=WAIT_BUDGET):
+    """ Opens `url` in a new tab without switching to it and returns the new
+    tab's window handle. The page loads in the background. Raises
+    TimeoutException if the tab does not show up within `timeout`. """
+    known_handles = set(browser.window_handles)
+    browser.execute_script("window.open(arguments[0], '_blank')", url)
+    explicit_wait(
+        browser, "NW", [len(known_handles) + 1], notify=False, timeout=timeout
+    )
+    for handle in browser.window_handles:
+        if handle not in known_handles:
+            return handle
+
+    raise exceptions.TimeoutException(
+        "No new window handle {}s after opening '{}'".format(timeout, url)
+    )
+
+
+def switch_to_tab(browser, tab):
+    """ Switch to `tab`, either a window handle or a tab number. The tabs
+    are numbered from 1 in the order that they are opened by the web driver.
+    """
+    if isinstance(tab, int):
+        assert (
+            tab <= len(browser.window_handles) and tab > 0
+        ), "Tab number must be less than or equal to the total number of tabs"
+
+        tab = browser.window_handles[tab - 1]
+    browser.switch_to.window(tab)
@@ -1,4 +1,12 @@
+import os
+import sys
+import math
+import time
+import pickle
 import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 from operator import itemgetter
 from base64 import b64encode, b64decode
@@ -7,15 +15,39 @@ import numpy
 import requests
 from requests.exceptions import HTTPError
 from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
 from elasticsearch.exceptions import ConflictError, NotFoundError
 from furl import furl
 from image_match import signature_database_base
 from image_match.elasticsearch_driver import SignatureES
 from image_match.goldberg import ImageSignature
 from logbook import Logger
+from PIL import Image
 
 
 class AdES(SignatureES):
+    # Whether records keep the signature as the base 64 of its int8 array,
+    # for indices mapped with `AD_INDEX_MAPPING`, or as a list of ints.
+    compact_signatures = True
+
+    def create_index(self):
+        """
+        Creates the index with `AD_INDEX_MAPPING` unless it exists, and
+        picks the signature format of the index that does.
+        """
+        self.es.indices.create(
+            index=self.index,
+            body={'mappings': {self.doc_type: AD_INDEX_MAPPING}},
+            ignore=400
+        )
+        mappings = self.es.indices.get_mapping(index=self.index)
+        properties = next(iter(mappings.values()))['mappings'].get(
+            self.doc_type, {}
+        ).get('properties', {})
+        self.compact_signatures = (
+            properties.get('signature', {}).get('type') == 'binary'
+        )
+
     def make_record_from_signature_base64(
         self, signature, path=None, metadata=None
     ):
@@ -36,8 +68,11 @@ class AdES(SignatureES):
         """
         record = dict()
         record['path'] = path
+        if self.compact_signatures:
+            record['signature'] = signature
         signature = image_signature_base64_to_array(signature)
-        record['signature'] = signature.tolist()
+        if not self.compact_signatures:
+            record['signature'] = signature.tolist()
         if metadata:
             record['metadata'] = metadata
 
@@ -62,6 +97,48 @@ class AdES(SignatureES):
         results = self.search_single_record(record)
         return sorted(results, key=itemgetter('dist'))
 
+    def search_single_record(self, rec):
+        """
+        `SignatureES.search_single_record` for signatures in either format;
+        packed ones are decoded with `numpy.frombuffer`.
+        """
+        rec = dict(rec)
+        rec.pop('path')
+        signature = signature_to_array(rec.pop('signature'))
+        rec.pop('metadata', None)
+
+        should = [{'term': {word: rec[word]}} for word in rec]
+        res = self.es.search(
+            index=self.index,
+            doc_type=self.doc_type,
+            body={
+                'query': {'bool': {'should': should}},
+                '_source': {'excludes': ['simple_word_*']}
+            },
+            size=self.size,
+            timeout=self.timeout
+        )['hits']['hits']
+        if not res:
+            return []
+
+        signatures = numpy.stack([
+            signature_to_array(hit['_source']['signature']) for hit in res
+        ])
+        dists = signature_database_base.normalized_distance(
+            signatures, signature
+        )
+        return [
+            {
+                'id': hit['_id'],
+                'score': hit['_score'],
+                'metadata': hit['_source'].get('metadata'),
+                'path': hit['_source'].get('url', hit['_source'].get('path')),
+                'dist': dist
+            }
+            for hit, dist in zip(res, dists)
+            if dist < self.distance_cutoff
+        ]
+
     def add_image_signature_base64(
         self, _id, signature, path=None, metadata=None
     ):
@@ -98,11 +175,70 @@ SOURCE_GENDER_KEY = 'gender'
 SOURCE_INTERESTS_KEY = 'interests'
 
 METADATA_IMAGE_KEY = 'image'
+# With a `BlobStore`, records keep this digest instead of the base64 image.
+METADATA_IMAGE_SHA256_KEY = 'image_sha256'
+
+# Mapping of new indices: the packed signature is stored but not indexed,
+# the words are searched but never sorted or aggregated on.
+AD_INDEX_MAPPING = {
+    'dynamic_templates': [{
+        'simple_words': {
+            'match': 'simple_word_*',
+            'mapping': {'type': 'long', 'doc_values': False}
+        }
+    }],
+    'properties': {
+        'path': {'type': 'keyword'},
+        'signature': {'type': 'binary'},
+        'timestamp': {'type': 'date'},
+        'metadata': {
+            'properties': {
+                METADATA_IMAGE_KEY: {'type': 'binary'},
+                METADATA_IMAGE_SHA256_KEY: {'type': 'keyword'},
+                METADATA_SOURCES_KEY: {
+                    'properties': {
+                        key: {'type': 'keyword'} for key in (
+                            SOURCE_URL_KEY, SOURCE_DOMAIN_KEY,
+                            SOURCE_EMAIL_KEY, SOURCE_AGE_KEY,
+                            SOURCE_GENDER_KEY, SOURCE_INTERESTS_KEY
+                        )
+                    }
+                }
+            }
+        }
+    }
+}
+
+# Run by Elasticsearch to append `params.sources` to a creative's sightings.
+APPEND_SOURCES_SCRIPT = 'ctx._source.metadata.sources.addAll(params.sources)'
 
 ADD_IMAGE_URL_MSG_FORMAT = 'Adding: {}'
 ADD_IMAGE_BYTES_MSG_FORMAT = 'Adding bytes.'
 ADD_IMAGE_URL_NO_SIGNATURE_MSG_FORMAT = 'Failed to get signature for: {}'
-ADD_IMAGE_URL_CONFLICT_MSG_FORMAT = 'Conflict, retrying: {}'
+ADD_IMAGE_SIGHTING_MSG_FORMAT = 'Perceptual hash hit, adding sighting: {}'
+BULK_FLUSH_MSG_FORMAT = 'Flushing {} buffered records.'
+BULK_ITEM_ERROR_MSG_FORMAT = 'Bulk update failed for {}: {}'
+
+# Bulk mode flushes once any of these is reached.
+BULK_SIZE = 500
+BULK_BYTES = 10 << 20
+BULK_INTERVAL = 5
+
+PHASH_INDEX_SUFFIX = '.phash'
+# Hashes within this many bits are treated as the same creative.
+PHASH_MAX_DISTANCE = 3
+PHASH_SAVE_EVERY = 100
+
+BLOB_STORE_SUFFIX = '.blobs'
+# Directory levels of two hex digits each: 65536 leaves for two.
+BLOB_SHARD_DEPTH = 2
+
+# Sized for this many creatives; beyond it the false positive rate climbs
+# but the memory stays put.
+KNOWN_IDS_CAPACITY = 1000000
+KNOWN_IDS_ERROR_RATE = 0.001
+KNOWN_IDS_LRU_SIZE = 10000
+KNOWN_IDS_SCROLL_SIZE = 5000
 
 
 class AdLoader(object):
@@ -112,8 +248,31 @@ class AdLoader(object):
         hosts=None,
         distance_cutoff=0.38,
         logger=None,
-        exceptions_to_reraise=None
+        exceptions_to_reraise=None,
+        use_phash_index=True,
+        phash_index_path=None,
+        bulk=False,
+        bulk_size=BULK_SIZE,
+        bulk_bytes=BULK_BYTES,
+        bulk_interval=BULK_INTERVAL,
+        use_known_ids=True,
+        known_ids_capacity=KNOWN_IDS_CAPACITY,
+        use_blob_store=True,
+        blob_store_path=None
     ):
+        """
+        With `bulk`, records are buffered and written by `flush` through the
+        `_bulk` API once `bulk_size` records, `bulk_bytes` bytes or
+        `bulk_interval` seconds have piled up. Use the loader as a context
+        manager, or call `close`, to flush the rest.
+
+        With `use_known_ids`, the IDs already in the index are loaded into a
+        `KnownIdCache` and sightings of those creatives are sent without
+        the full record.
+
+        With `use_blob_store`, image bytes go to a `BlobStore` and records
+        only reference them; see `get_image_bytes`.
+        """
         self._iss = ImageSignatureService()
         self._es = Elasticsearch(hosts=hosts)
         self._aes = AdES(
@@ -135,15 +294,58 @@ class AdLoader(object):
         # Ensure the index to be used exists.
         self.create_index()
 
+        # Repeats of known creatives skip the signature in `add_image_bytes`.
+        self.phash_index = None
+        if use_phash_index:
+            self.phash_index = PerceptualHashIndex(
+                path=phash_index_path or index + PHASH_INDEX_SUFFIX
+            )
+
+        self.blob_store = None
+        if use_blob_store:
+            self.blob_store = BlobStore(
+                blob_store_path or index + BLOB_STORE_SUFFIX
+            )
+
+        self.known_ids = None
+        if use_known_ids:
+            self.known_ids = KnownIdCache(capacity=known_ids_capacity)
+            self.known_ids.seed(self._es, self._aes.index, self._aes.doc_type)
+
         self.num_images_inserted = 0
         self.num_images_updated = 0
         self.num_images_errored = 0
 
+        self.bulk = bulk
+        self.bulk_size = bulk_size
+        self.bulk_bytes = bulk_bytes
+        self.bulk_interval = bulk_interval
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+
+    def close(self):
+        """ Flushes buffered records and persists local state (the
+        perceptual hash index) """
+        try:
+            self.flush()
+        finally:
+            if self.phash_index is not None:
+                self.phash_index.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def create_index(self):
-        self._es.indices.create(self._aes.index, ignore=400)
+        self._aes.create_index()
 
     def delete_index(self):
         self._es.indices.delete(index=self._aes.index)
+        if self.known_ids is not None:
+            self.known_ids.clear()
 
     def wipe_index(self):
         self.delete_index()
@@ -152,18 +354,9 @@ class AdLoader(object):
     def refresh_index(self):
         self._es.indices.refresh(index=self._aes.index)
 
-    def _add_image_to_index(
-            self,
-            image_signature,
-            image,
-            image_url,
-            source_url,
-            email,
-            age,
-            gender,
-            interests
-    ):
-        source = {
+    @staticmethod
+    def _make_source(source_url, email, age, gender, interests):
+        return {
             SOURCE_URL_KEY: source_url,
             SOURCE_DOMAIN_KEY: furl(source_url).netloc,
             SOURCE_EMAIL_KEY: email,
@@ -171,39 +364,75 @@ class AdLoader(object):
             SOURCE_GENDER_KEY: gender,
             SOURCE_INTERESTS_KEY: interests
         }
-        _id = hashlib.sha512(image_signature.encode('utf-8')).hexdigest()
-        existing_document = None
-        try:
-            get_result = self._es.get(
-                index=self._aes.index, doc_type=self._aes.doc_type, id=_id
-            )
-            existing_document = get_result['_source']
 
-        except NotFoundError:
-            pass
-
-        if existing_document:
-            existing_sources = existing_document['metadata'][
-                METADATA_SOURCES_KEY
-            ]
-            existing_sources.append(source)
-            self._es.update(
-                index=self._aes.index,
-                doc_type=self._aes.doc_type,
-                id=_id,
-                body={'doc': existing_document}
-            )
-            self.num_images_updated += 1
+    @staticmethod
+    def _signature_id(image_signature):
+        return hashlib.sha512(image_signature.encode('utf-8')).hexdigest()
 
+    def _make_record(self, image_signature, image, image_url, sources):
+        metadata = {METADATA_SOURCES_KEY: sources}
+        if self.blob_store is not None:
+            metadata[METADATA_IMAGE_SHA256_KEY] = self.blob_store.put(
+                b64decode(image)
+            )
         else:
-            metadata = {
-                METADATA_SOURCES_KEY: [source],
-                METADATA_IMAGE_KEY: image
+            metadata[METADATA_IMAGE_KEY] = image
+        record = self._aes.make_record_from_signature_base64(
+            image_signature, path=image_url, metadata=metadata
+        )
+        record['timestamp'] = datetime.utcnow()
+        return record
+
+    @staticmethod
+    def _append_sources_body(sources, record=None):
+        """
+        Update body that appends `sources` on the server side, creating the
+        creative from `record` when it is not indexed yet
+        """
+        body = {
+            'script': {
+                'source': APPEND_SOURCES_SCRIPT,
+                'lang': 'painless',
+                'params': {'sources': sources}
             }
-            self._aes.add_image_signature_base64(
-                _id, image_signature, path=image_url, metadata=metadata
-            )
-            self.num_images_inserted += 1
+        }
+        if record is not None:
+            body['upsert'] = record
+        return body
+
+    def _upsert_sources(self, _id, sources, record=None):
+        """
+        Appends `sources` to the creative under `_id` in one request.
+        Returns 'created' or 'updated'; raises NotFoundError if there is no
+        such creative and no `record` to create it from.
+        """
+        response = self._es.update(
+            index=self._aes.index,
+            doc_type=self._aes.doc_type,
+            id=_id,
+            body=self._append_sources_body(sources, record),
+            retry_on_conflict=MAX_CONFLICT_RETRIES
+        )
+        return response['result']
+
+    def _append_source(self, _id, source):
+        """
+        Appends a sighting to an existing document. Returns False if there
+        is no document with this ID.
+        """
+        try:
+            self._upsert_sources(_id, [source])
+
+        except NotFoundError:
+            return False
+
+        self.num_images_updated += 1
+        if self.known_ids is not None:
+            self.known_ids.add(_id)
+        return True
+
+    def _is_known(self, _id):
+        return self.known_ids is not None and _id in self.known_ids
 
     def _add_image(
             self,
@@ -214,42 +443,32 @@ class AdLoader(object):
             email,
             age,
             gender,
-            interests,
-            retry_num=0
+            interests
     ):
-        try:
-            self._add_image_to_index(
-                image_signature,
-                image,
-                image_url,
-                source_url,
-                email,
-                age,
-                gender,
-                interests
-            )
+        source = self._make_source(source_url, email, age, gender, interests)
+        _id = self._signature_id(image_signature)
+        if self.bulk:
+            self._buffer({
+                'id': _id,
+                'source': source,
+                'signature': image_signature,
+                'image': image,
+                'path': image_url
+            }, len(image_signature) + len(image))
+            return
 
-        except ConflictError:
-            if retry_num >= MAX_CONFLICT_RETRIES:
-                self.logger.exception()
-                self.num_images_errored += 1
+        if self._is_known(_id):
+            if self._append_source(_id, source):
+                return
+            self.known_ids.false_positive(_id)
 
-            else:
-                self.logger.warning(
-                    ADD_IMAGE_URL_CONFLICT_MSG_FORMAT.format(image_url)
-                )
-                retry_num += 1
-                self._add_image(
-                    image_signature,
-                    image,
-                    image_url,
-                    source_url,
-                    email,
-                    age,
-                    gender,
-                    interests,
-                    retry_num=retry_num
-                )
+        record = self._make_record(image_signature, image, image_url, [source])
+        if self._upsert_sources(_id, [source], record) == 'created':
+            self.num_images_inserted += 1
+        else:
+            self.num_images_updated += 1
+        if self.known_ids is not None:
+            self.known_ids.add(_id)
 
     def add_image_url(
             self, image_url, source_url, email, age, gender, interests
@@ -283,11 +502,45 @@ class AdLoader(object):
             self.logger.exception()
             self.num_images_errored += 1
 
+    def _add_sighting(self, _id, source_url, email, age, gender, interests):
+        """
+        Appends a sighting to a creative already indexed under `_id`.
+        Returns False if it must go through `_add_image` instead.
+        """
+        self.logger.debug(ADD_IMAGE_SIGHTING_MSG_FORMAT.format(_id))
+        source = self._make_source(source_url, email, age, gender, interests)
+        try:
+            return self._append_source(_id, source)
+
+        except ConflictError:
+            return False
+
     def add_image_bytes(
             self, image_bytes, source_url, email, age, gender, interests
     ):
         try:
             self.logger.debug(ADD_IMAGE_URL_MSG_FORMAT.format('from bytes'))
+            image_hash = None
+            if self.phash_index is not None:
+                image_hash = self.phash_index.hash_bytes(image_bytes)
+                _id = self.phash_index.lookup(image_hash)
+                if _id is not None and self.bulk:
+                    # Checked at flush; falls back to the signature there.
+                    self._buffer({
+                        'id': _id,
+                        'source': self._make_source(
+                            source_url, email, age, gender, interests
+                        ),
+                        'image_bytes': image_bytes,
+                        'image_hash': image_hash
+                    }, len(image_bytes))
+                    return
+
+                if _id is not None and self._add_sighting(
+                    _id, source_url, email, age, gender, interests
+                ):
+                    return
+
             image_signature, image = self._iss.get_image_signature_from_bytes(
                 image_bytes
             )
@@ -302,6 +555,10 @@ class AdLoader(object):
                     gender,
                     interests
                 )
+                if image_hash is not None:
+                    self.phash_index.add(
+                        image_hash, self._signature_id(image_signature)
+                    )
 
             else:
                 self.logger.warning(
@@ -315,6 +572,181 @@ class AdLoader(object):
             self.logger.exception()
             self.num_images_errored += 1
 
+    def _buffer(self, record, num_bytes):
+        if not self._pending:
+            self._pending_since = time.monotonic()
+        self._pending.append(record)
+        self._pending_bytes += num_bytes
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """ Flushes once a bulk threshold is reached; call it while idle so
+        the time threshold holds without new records """
+        if self._pending and (
+            len(self._pending) >= self.bulk_size
+            or self._pending_bytes >= self.bulk_bytes
+            or time.monotonic() - self._pending_since >= self.bulk_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered records as one `_bulk` request of scripted
+        upserts, one per creative. Sightings of creatives that turn out to
+        be missing are signed and written by a further round. """
+        while self._pending:
+            pending = self._pending
+            self._pending = []
+            self._pending_bytes = 0
+            self._pending_since = None
+            self.logger.debug(BULK_FLUSH_MSG_FORMAT.format(len(pending)))
+            accounted = []
+            try:
+                self._flush(pending, accounted)
+
+            except self.exceptions_to_reraise:
+                raise
+
+            except Exception:
+                self.logger.exception()
+                # Records already counted or queued again are not errors.
+                self.num_images_errored += len(pending) - len(accounted)
+
+    def _flush(self, pending, accounted):
+        """ Sends `pending`, appending each record to `accounted` once its
+        result is counted or it is queued for the next round """
+        records_by_id = OrderedDict()
+        for record in pending:
+            records_by_id.setdefault(record['id'], []).append(record)
+
+        actions = []
+        for _id, records in records_by_id.items():
+            sources = [record['source'] for record in records]
+            images = [record for record in records if 'signature' in record]
+            upsert = None
+            if images and (
+                any(record.get('missed') for record in images)
+                or not self._is_known(_id)
+            ):
+                upsert = self._make_record(
+                    images[0]['signature'],
+                    images[0]['image'],
+                    images[0]['path'],
+                    sources
+                )
+            actions.append({'update': {
+                '_index': self._aes.index,
+                '_type': self._aes.doc_type,
+                '_id': _id,
+                'retry_on_conflict': MAX_CONFLICT_RETRIES
+            }})
+            actions.append(self._append_sources_body(sources, upsert))
+
+        response = self._es.bulk(body=actions)
+        for (_id, records), item in zip(
+            records_by_id.items(), response['items']
+        ):
+            # One item failing here must not count the others as errors:
+            # Elasticsearch already has their results.
+            num_accounted = len(accounted)
+            try:
+                self._flush_result(_id, records, item['update'], accounted)
+
+            except self.exceptions_to_reraise:
+                raise
+
+            except Exception:
+                self.logger.exception()
+                self.num_images_errored += (
+                    len(records) - (len(accounted) - num_accounted)
+                )
+
+    def _flush_result(self, _id, records, result, accounted):
+        """ Counts or requeues the records of one `_bulk` item """
+        if 'error' not in result:
+            if result['result'] == 'created':
+                self.num_images_inserted += 1
+                self.num_images_updated += len(records) - 1
+            else:
+                self.num_images_updated += len(records)
+            accounted.extend(records)
+            if self.known_ids is not None:
+                self.known_ids.add(_id)
+
+        elif result.get('status') == 404:
+            # Sent without a record: only sightings, or a known ID that
+            # was not. The next round sends the record.
+            if any('signature' in record for record in records):
+                self.known_ids.false_positive(_id)
+                for record in records:
+                    record['missed'] = True
+                    self._pending.append(record)
+                accounted.extend(records)
+            else:
+                for record in records:
+                    self._sighting_missed(record)
+                    accounted.append(record)
+
+        else:
+            self.logger.error(BULK_ITEM_ERROR_MSG_FORMAT.format(
+                _id, result['error']
+            ))
+            self.num_images_errored += len(records)
+            accounted.extend(records)
+
+    def _sighting_missed(self, record):
+        """ A buffered perceptual hash sighting whose creative is not in the
+        index: signs the image and queues it like `add_image_bytes` """
+        image_signature, image = self._iss.get_image_signature_from_bytes(
+            record['image_bytes']
+        )
+        if not image_signature:
+            self.logger.warning(
+                ADD_IMAGE_URL_NO_SIGNATURE_MSG_FORMAT.format('from bytes')
+            )
+            return
+
+        _id = self._signature_id(image_signature)
+        self._pending.append({
+            'id': _id,
+            'source': record['source'],
+            'signature': image_signature,
+            'image': image,
+            'path': image_signature
+        })
+        self.phash_index.add(record['image_hash'], _id)
+
+    def get_image_bytes(self, _id):
+        """ The image of the creative indexed under `_id`, or None """
+        try:
+            document = self._es.get(
+                index=self._aes.index,
+                doc_type=self._aes.doc_type,
+                id=_id,
+                _source_include=[
+                    'metadata.' + METADATA_IMAGE_SHA256_KEY,
+                    'metadata.' + METADATA_IMAGE_KEY
+                ]
+            )
+
+        except NotFoundError:
+            return None
+
+        return self.image_bytes_from_metadata(
+            document['_source'].get('metadata', {})
+        )
+
+    def image_bytes_from_metadata(self, metadata):
+        """ The image of a record's or a match's `metadata`, or None. Reads
+        the `BlobStore` only now, and records from before it. """
+        digest = metadata.get(METADATA_IMAGE_SHA256_KEY)
+        if digest is None:
+            image = metadata.get(METADATA_IMAGE_KEY)
+            return b64decode(image) if image is not None else None
+
+        if self.blob_store is None:
+            return None
+        return self.blob_store.get(digest)
+
     def get_image_match_by_image_url(self, image_url):
         return self._aes.search_image(image_url)
 
@@ -332,6 +764,13 @@ def image_signature_base64_to_array(image_signature_base64):
     return numpy.frombuffer(b64decode(image_signature_base64), dtype='int8')
 
 
+def signature_to_array(signature):
+    """ A stored signature, packed or a list of ints, as an int8 array """
+    if isinstance(signature, str):
+        return image_signature_base64_to_array(signature)
+    return numpy.array(signature, dtype='int8')
+
+
 class ImageSignatureService(object):
     def __init__(self):
         self._gis = ImageSignature()
@@ -368,3 +807,342 @@ class ImageSignatureService(object):
                 return self._get_image_signature_from_url(
                     image_url, retry_num=retry_num
                 )
+
+
+def dhash(image_bytes, hash_size=8):
+    """ Difference hash: one bit per horizontally adjacent pixel pair of a
+    `hash_size` x `hash_size` grayscale thumbnail """
+    image = Image.open(BytesIO(image_bytes)).convert('L').resize(
+        (hash_size + 1, hash_size), Image.BILINEAR
+    )
+    pixels = list(image.getdata())
+    image_hash = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            image_hash <<= 1
+            image_hash |= pixels[offset + col] < pixels[offset + col + 1]
+    return image_hash
+
+
+def ahash(image_bytes, hash_size=8):
+    """ Average hash: one bit per pixel of a `hash_size` x `hash_size`
+    grayscale thumbnail, set when it is above the mean """
+    image = Image.open(BytesIO(image_bytes)).convert('L').resize(
+        (hash_size, hash_size), Image.BILINEAR
+    )
+    pixels = list(image.getdata())
+    mean = sum(pixels) / len(pixels)
+    image_hash = 0
+    for pixel in pixels:
+        image_hash = (image_hash << 1) | (pixel > mean)
+    return image_hash
+
+
+PERCEPTUAL_HASHES = {
+    'dhash': dhash,
+    'ahash': ahash,
+}
+
+PerceptualHashIndexInfo = namedtuple(
+    'PerceptualHashIndexInfo', ['hits', 'misses', 'hit_rate', 'size']
+)
+
+
+class PerceptualHashIndex(object):
+    """
+    Maps 64-bit perceptual hashes of creatives to their Elasticsearch IDs,
+    so exact and near-exact repeats can skip the Goldberg signature.
+
+    Near-exact lookups split each hash into `max_distance + 1` bands: two
+    hashes within `max_distance` bits agree on at least one whole band, so
+    only hashes sharing a band are compared. The index is pickled to `path`
+    every `save_every` additions and on `save`.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        hash_name='dhash',
+        max_distance=PHASH_MAX_DISTANCE,
+        save_every=PHASH_SAVE_EVERY
+    ):
+        self.path = path
+        self.hash_name = hash_name
+        self.max_distance = max_distance
+        self.save_every = save_every
+        self.hits = 0
+        self.misses = 0
+        self._unsaved = 0
+        self._ids = {}
+        self._bands = [{} for _ in range(max_distance + 1)]
+        self._load()
+
+    def _band_keys(self, image_hash):
+        band_bits = -(-64 // len(self._bands))
+        mask = (1 << band_bits) - 1
+        return [
+            (image_hash >> (i * band_bits)) & mask
+            for i in range(len(self._bands))
+        ]
+
+    def hash_bytes(self, image_bytes):
+        return PERCEPTUAL_HASHES[self.hash_name](image_bytes)
+
+    def lookup(self, image_hash):
+        """ Returns the ID stored for `image_hash` or for a hash within
+        `max_distance` bits of it, else None """
+        _id = self._ids.get(image_hash)
+        if _id is None:
+            for band, key in zip(self._bands, self._band_keys(image_hash)):
+                for candidate in band.get(key, ()):
+                    distance = bin(candidate ^ image_hash).count('1')
+                    if distance <= self.max_distance:
+                        _id = self._ids[candidate]
+                        break
+                if _id is not None:
+                    break
+
+        if _id is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return _id
+
+    def _insert(self, image_hash, _id):
+        if image_hash not in self._ids:
+            for band, key in zip(self._bands, self._band_keys(image_hash)):
+                band.setdefault(key, []).append(image_hash)
+        self._ids[image_hash] = _id
+
+    def add(self, image_hash, _id):
+        self._insert(image_hash, _id)
+        self._unsaved += 1
+        if self._unsaved >= self.save_every:
+            self.save()
+
+    def info(self):
+        lookups = self.hits + self.misses
+        return PerceptualHashIndexInfo(
+            self.hits,
+            self.misses,
+            self.hits / lookups if lookups else 0.0,
+            len(self._ids)
+        )
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'rb') as file:
+                state = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        if (
+            state.get('hash_name') != self.hash_name
+            or state.get('max_distance') != self.max_distance
+        ):
+            return
+        for image_hash, _id in state['ids'].items():
+            self._insert(image_hash, _id)
+
+    def save(self):
+        self._unsaved = 0
+        if not self.path:
+            return
+        state = {
+            'hash_name': self.hash_name,
+            'max_distance': self.max_distance,
+            'ids': self._ids
+        }
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print('Exception writing perceptual hash index:', e)
+
+
+class BlobStore(object):
+    """
+    Image bytes on disk, named by their sha256 and sharded by its leading
+    hex digits: root/ab/cd/abcd.... A blob is written to a temporary file
+    and renamed into place, so it is either whole or absent, and writing
+    the same bytes twice is a no-op.
+    """
+
+    def __init__(self, root, shard_depth=BLOB_SHARD_DEPTH):
+        self.root = root
+        self.shard_depth = shard_depth
+
+    def path(self, digest):
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.shard_depth)]
+        return os.path.join(self.root, *shards, digest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, data):
+        """ Stores `data` and returns its sha256 hex digest """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.get_ident()
+        )
+        try:
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest
+
+    def get(self, digest):
+        """ The bytes stored under `digest`, or None """
+        try:
+            with open(self.path(digest), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+
+KnownIdCacheInfo = namedtuple(
+    'KnownIdCacheInfo', [
+        'lru_hits', 'bloom_hits', 'misses', 'false_positives',
+        'false_positive_rate', 'expected_false_positive_rate', 'size',
+        'num_bytes'
+    ]
+)
+
+
+class KnownIdCache(object):
+    """
+    Which creative IDs are already indexed, so `AdLoader` can send their
+    sightings without the full record. An exact LRU of the `lru_size`
+    most recently confirmed IDs sits in front of a Bloom filter sized for
+    `capacity` IDs at `error_rate`; both have a fixed footprint.
+
+    A Bloom filter hit can be wrong: report those with `false_positive`,
+    which also drops IDs that were deleted from the LRU.
+    """
+
+    def __init__(
+        self,
+        capacity=KNOWN_IDS_CAPACITY,
+        error_rate=KNOWN_IDS_ERROR_RATE,
+        lru_size=KNOWN_IDS_LRU_SIZE
+    ):
+        self.num_bits = int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        self.num_hashes = max(1, round(
+            self.num_bits / capacity * math.log(2)
+        ))
+        self.lru_size = lru_size
+        self.lru_hits = 0
+        self.bloom_hits = 0
+        self.misses = 0
+        self.false_positives = 0
+        self._bits = bytearray(-(-self.num_bits // 8))
+        self._num_ids = 0
+        self._lru = OrderedDict()
+
+    def _positions(self, _id):
+        digest = hashlib.md5(_id.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [
+            (first + i * step) % self.num_bits
+            for i in range(self.num_hashes)
+        ]
+
+    def _in_bloom(self, _id):
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(_id)
+        )
+
+    def __contains__(self, _id):
+        if _id in self._lru:
+            self._lru.move_to_end(_id)
+            self.lru_hits += 1
+            return True
+
+        if self._in_bloom(_id):
+            self.bloom_hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def add(self, _id):
+        if _id in self._lru:
+            self._lru.move_to_end(_id)
+            return
+
+        self._lru[_id] = None
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+        self._add_to_bloom(_id)
+
+    def false_positive(self, _id):
+        """ `_id` was reported known but is not in the index """
+        if _id in self._lru:
+            # Deleted from the index since it was confirmed.
+            del self._lru[_id]
+        else:
+            self.false_positives += 1
+
+    def seed(self, es, index, doc_type, size=KNOWN_IDS_SCROLL_SIZE):
+        """ Adds the ID of every document in `index`, scrolling `size` IDs
+        at a time without their sources """
+        for hit in scan(
+            es,
+            index=index,
+            doc_type=doc_type,
+            query={'_source': False},
+            size=size
+        ):
+            self._add_to_bloom(hit['_id'])
+
+    def _add_to_bloom(self, _id):
+        # Counts IDs that set at least one new bit, i.e. distinct ones bar
+        # those the filter already (falsely) held.
+        added = False
+        for position in self._positions(_id):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                added = True
+        self._num_ids += added
+
+    def clear(self):
+        self._bits = bytearray(len(self._bits))
+        self._num_ids = 0
+        self._lru.clear()
+
+    def info(self):
+        """ `false_positive_rate` is the share of unindexed IDs that were
+        reported known, as measured; `expected_false_positive_rate`
+        follows from how many IDs the filter holds """
+        negatives = self.false_positives + self.misses
+        expected = (
+            1 - math.exp(-self.num_hashes * self._num_ids / self.num_bits)
+        ) ** self.num_hashes
+        return KnownIdCacheInfo(
+            self.lru_hits,
+            self.bloom_hits,
+            self.misses,
+            self.false_positives,
+            self.false_positives / negatives if negatives else 0.0,
+            expected,
+            self._num_ids,
+            len(self._bits) + sys.getsizeof(self._lru)
+            + sum(map(sys.getsizeof, self._lru))
+        )
@@ -1,3 +1,10 @@
+import os
+import copy
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.keys import Keys
@@ -5,7 +12,7 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.action_chains import ActionChains
-from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import TimeoutException, WebDriverException
 
 chrome_options = Options()
 chromeOptions = webdriver.ChromeOptions()
@@ -13,8 +20,28 @@ user_agent = '"Mozilla/5.0 (Linux; Android 9; Pixel 3 Build/PQ3A.190801.002; wv)
 chrome_options.add_argument('--headless')
 chrome_options.add_argument('--incognito')
 chrome_options.add_argument('--user-agent=%s' % user_agent)
+# Network events for `ad_images.wait_for_page_ready`.
+chrome_options.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
 
 CONFIG_FILE = "accounts.config"
+SESSION_CACHE_FILE = "sessions.cache"
+SESSION_VALIDATION_WORKERS = 4
+
+
+def start_chrome(blocking_profile=None):
+    """ Starts Chrome with `chrome_options`, blocking resources with a
+    `resource_blocking.ResourceBlockingProfile` if one is given """
+    if blocking_profile is None:
+        return webdriver.Chrome(options=chrome_options)
+
+    options = blocking_profile.add_to_options(copy.deepcopy(chrome_options))
+    driver = webdriver.Chrome(options=options)
+    try:
+        blocking_profile.apply(driver)
+    except WebDriverException:
+        driver.quit()
+        raise
+    return driver
 
 
 def read_all_logins(conf_file=CONFIG_FILE):
@@ -25,8 +52,8 @@ def read_all_logins(conf_file=CONFIG_FILE):
     return accounts
 
 
-def google_login(username, password):  # See test_cookies for example on how to use the cookies field from the dictionary
-    driver = webdriver.Chrome(options=chrome_options)
+def google_login(username, password, session_cache=None, blocking_profile=None):  # See test_cookies for example on how to use the cookies field from the dictionary
+    driver = start_chrome(blocking_profile)
 
     driver.get('https://accounts.google.com/ServiceLogin?hl=en&passive=true&continue=https://www.google.com/')
     user_input = driver.find_element_by_xpath('//div//input[@type="email"]')
@@ -55,31 +82,216 @@ def google_login(username, password):  # See test_cookies for example on how to
     cookies = driver.get_cookies()
 
     for cookie in cookies:
-        cookie['expiry'] = int(cookie['expiry'])  # expiry being an integer is part of the WebDriver specs
+        if 'expiry' in cookie:  # session cookies have none
+            cookie['expiry'] = int(cookie['expiry'])  # expiry being an integer is part of the WebDriver specs
+
+    if session_cache is not None:
+        session_cache.store(username, cookies)
 
     #driver.close()
     return driver
     #return {'username': username, 'cookies': cookies, 'meta': meta}
 
 
-def test_cookies(c):  # Returns true for valid login cookies
-    driver = webdriver.Chrome(options=chrome_options)
-
+def add_cookies(driver, cookies):
+    """ Loads google.com and injects `cookies` into the session """
     driver.get('https://www.google.com/')  # Note that due to WebDriver specs, the cookie must be added while on the original domain
     driver.delete_all_cookies()
 
-    for d in c:
-        driver.add_cookie(d)
+    for d in cookies:
+        try:
+            driver.add_cookie(d)
+        except WebDriverException as e:
+            print('Exception adding cookie:', d.get('name'), e)
 
-    driver.get('https://adssettings.google.com/authenticated')
 
+def login_with_cookies(cookies, blocking_profile=None):
+    """ Returns a new driver carrying `cookies`, without the sign-in flow """
+    driver = start_chrome(blocking_profile)
     try:
-        WebDriverWait(driver, 10).until(
-            EC.title_is('Ad Settings')
-        )
-    except TimeoutException:
-        driver.close()
-        return False
+        add_cookies(driver, cookies)
+    except WebDriverException:
+        driver.quit()
+        raise
+    return driver
+
+
+class SessionCache(object):
+    """
+    On-disk login cookies per account (JSON, readable by the owner only).
+    Cookies past their `expiry` are dropped on read; `validate` checks the
+    rest with `test_cookies` in parallel and forgets the accounts that are
+    no longer signed in.
+    """
+
+    def __init__(self, path=SESSION_CACHE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sessions = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as file:
+                json.dump(self._sessions, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print('Exception writing session cache:', e)
+
+    def get(self, username):
+        """ Returns the unexpired cookies cached for `username`, or None """
+        with self._lock:
+            session = self._sessions.get(username)
+        if not session:
+            return None
+        now = time.time()
+        cookies = [
+            cookie for cookie in session['cookies']
+            if cookie.get('expiry', now + 1) > now
+        ]
+        return cookies or None
+
+    def store(self, username, cookies):
+        with self._lock:
+            # Other processes may have stored their accounts since we read.
+            self._sessions = self._load()
+            self._sessions[username] = {
+                'cookies': cookies, 'stored': int(time.time())
+            }
+            self._save()
+
+    def discard(self, username):
+        with self._lock:
+            self._sessions = self._load()
+            if self._sessions.pop(username, None) is not None:
+                self._save()
+
+    def validate(self, usernames, max_workers=SESSION_VALIDATION_WORKERS):
+        """ Checks the cached cookies of `usernames` with `test_cookies`,
+        several browsers at a time. Returns the usernames still valid. """
+        usernames = [username for username in usernames if self.get(username)]
+
+        def check(username):
+            try:
+                return test_cookies(self.get(username))
+            except WebDriverException as e:
+                print('Exception testing cookies:', username, e)
+                return False
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(check, usernames))
+
+        valid = set()
+        for username, is_valid in zip(usernames, results):
+            if is_valid:
+                valid.add(username)
+            else:
+                self.discard(username)
+        return valid
+
+
+class GoogleSession(object):
+    """
+    One logged-in Chrome for an account, reused across page visits. The
+    browser is replaced by a fresh login after `recycle_after` pages (never
+    if None) or when it has crashed. Browsers start with `blocking_profile`
+    (see `start_chrome`).
+    """
+
+    def __init__(
+        self, username, password, recycle_after=None, session_cache=None,
+        blocking_profile=None
+    ):
+        self.username = username
+        self.password = password
+        self.recycle_after = recycle_after
+        self.session_cache = session_cache
+        self.blocking_profile = blocking_profile
+        self.num_logins = 0
+        self.num_cookie_logins = 0
+        self.num_pages = 0
+        self._driver = None
+
+    def get_driver(self):
+        """
+        Returns the session's driver, starting one with the cached cookies
+        or, on a cache miss, through the interactive login. Returns None if
+        the login fails.
+        """
+        if self._driver is None:
+            self.num_pages = 0
+            cookies = None
+            if self.session_cache is not None:
+                cookies = self.session_cache.get(self.username)
+            if cookies:
+                try:
+                    self._driver = login_with_cookies(
+                        cookies, self.blocking_profile
+                    )
+                    self.num_cookie_logins += 1
+                    return self._driver
+                except WebDriverException as e:
+                    print('Exception injecting cookies:', e)
+
+            self._driver = google_login(
+                self.username, self.password, self.session_cache,
+                self.blocking_profile
+            )
+            self.num_logins += 1
+        return self._driver
+
+    def is_alive(self):
+        if self._driver is None:
+            return False
+        try:
+            self._driver.current_url
+        except WebDriverException:
+            return False
+        return True
+
+    def page_done(self):
+        """ Call after each page; recycles the browser when due or dead """
+        self.num_pages += 1
+        if self._driver is None:
+            return
+        if (
+            self.recycle_after and self.num_pages >= self.recycle_after
+        ) or not self.is_alive():
+            self.close()
+
+    def close(self):
+        if self._driver is not None:
+            try:
+                self._driver.quit()
+            except WebDriverException:
+                pass
+            self._driver = None
+
+
+def test_cookies(c):  # Returns true for valid login cookies
+    driver = webdriver.Chrome(options=chrome_options)
+    try:
+        add_cookies(driver, c)
+
+        driver.get('https://adssettings.google.com/authenticated')
+
+        try:
+            WebDriverWait(driver, 10).until(
+                EC.title_is('Ad Settings')
+            )
+        except TimeoutException:
+            return False
+
+        return True
 
-    driver.close()
-    return True
+    finally:
+        # quit, not close: also stops chromedriver
+        driver.quit()
@@ -1,5 +1,10 @@
-from google_login import read_all_logins, google_login
-from ad_images import get_ad_images_from_url
+import os
+import time
+import queue
+import multiprocessing
+
+from google_login import read_all_logins, GoogleSession, SessionCache
+from ad_images import get_ad_images_from_url, get_ad_images_pipelined
 from data_access import AdLoader
 
 SITES = [
@@ -15,16 +20,260 @@ SITES = [
     'https://bootsnipp.com/'
 ]
 
+# Rough footprint of one worker process with its Chrome.
+WORKER_MEMORY_BYTES = 1 << 30
+RESULT_POLL_SECONDS = 1
+
+
+def _visit_sites(session, capture='crop', pipeline_depth=0):
+    """
+    Yields `(site, ad images bytes)` for every site in `SITES`, stopping if
+    the login fails. With `pipeline_depth` > 0 the next sites load in
+    background tabs while the current one is analyzed; the browser is still
+    recycled between chunks of `recycle_after` sites, and a crashed browser
+    is replaced and the chunk resumed from the first site not yielded.
+    """
+    if pipeline_depth > 0:
+        chunk_size = session.recycle_after or len(SITES)
+        for start in range(0, len(SITES), chunk_size):
+            remaining = SITES[start:start + chunk_size]
+            while remaining:
+                driver = session.get_driver()
+                if driver is None:
+                    print('Login failed, skipping account:', session.username)
+                    return
+                pages = get_ad_images_pipelined(
+                    driver, remaining, depth=pipeline_depth, capture=capture,
+                    blocking_profile=session.blocking_profile
+                )
+                crashed = False
+                for site, ad_images_bytes in pages:
+                    remaining = remaining[1:]  # yielded in order
+                    session.page_done()
+                    yield site, ad_images_bytes
+                    if remaining and not session.is_alive():
+                        crashed = True
+                        break
+                if not crashed:
+                    break
+                # Every restart has yielded at least one site, so this ends.
+                print('Browser crashed, resuming at:', remaining[0])
+
+            if remaining:
+                print('Skipped sites for {}: {}'.format(
+                    session.username, ', '.join(remaining)
+                ))
+        return
+
+    for site in SITES:
+        driver = session.get_driver()
+        if driver is None:
+            print('Login failed, skipping account:', session.username)
+            return
+
+        ad_images_bytes = get_ad_images_from_url(
+            driver, site, capture=capture, quit_driver=False
+        )
+        session.page_done()
+        yield site, ad_images_bytes
+
+
+def run(
+    capture='crop', recycle_after=None, pipeline_depth=0,
+    blocking_profile=None
+):
+    """
+    Visits every site with every account, reusing one logged-in browser per
+    account. `recycle_after` pages (or a crash) trigger a fresh login, from
+    the session cache when its cookies are still valid. `pipeline_depth`
+    sites are preloaded in background tabs (see `get_ad_images_pipelined`).
+    A `resource_blocking.ResourceBlockingProfile` keeps the browsers from
+    downloading what the ads do not need.
+    """
+    accounts = list(read_all_logins())
+    session_cache = SessionCache()
+    valid = session_cache.validate([account[0] for account in accounts])
+    print('Cached sessions still valid: {}/{}'.format(
+        len(valid), len(accounts)
+    ))
+    with AdLoader(index='final', bulk=True) as ad_loader:
+        for account in accounts:
+            email, password, age, gender = account
+            session = GoogleSession(
+                email, password, recycle_after=recycle_after,
+                session_cache=session_cache, blocking_profile=blocking_profile
+            )
+            start = time.monotonic()
+            try:
+                pages = _visit_sites(session, capture, pipeline_depth)
+                for site, ad_images_bytes in pages:
+                    for ad_image_bytes in ad_images_bytes:
+                        ad_loader.add_image_bytes(
+                            ad_image_bytes, site, email, age, gender, []
+                        )
+
+            finally:
+                session.close()
+
+            print('{}: {:.1f}s, {} login(s), {} from cached cookies'.format(
+                email, time.monotonic() - start, session.num_logins,
+                session.num_cookie_logins
+            ))
+
+    print('Perceptual hash index:', ad_loader.phash_index.info())
+    print('Known IDs:', ad_loader.known_ids.info())
+
+
+def default_worker_count(num_accounts):
+    """ One worker per account, capped by CPUs and by the physical memory
+    available for `WORKER_MEMORY_BYTES` per worker """
+    limit = os.cpu_count() or 1
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        limit = min(limit, max(1, available // WORKER_MEMORY_BYTES))
+    except (ValueError, OSError, AttributeError):
+        pass
+    return max(1, min(limit, num_accounts))
+
+
+def _account_worker(
+    worker_id, accounts, results, capture, recycle_after, pipeline_depth,
+    blocking_profile
+):
+    """ Runs in its own process: takes accounts off `accounts` until a None
+    sentinel and streams every page's ads to `results` """
+    session_cache = SessionCache()
+    while True:
+        account = accounts.get()
+        if account is None:
+            break
 
-def run():
-    ad_loader = AdLoader(index='final')
-    accounts = read_all_logins()
-    for account in accounts:
         email, password, age, gender = account
-        for site in SITES:
-            driver = google_login(email, password)
-            ad_images_bytes = get_ad_images_from_url(driver, site)
+        results.put(('account_start', worker_id, email))
+        session = GoogleSession(
+            email, password, recycle_after=recycle_after,
+            session_cache=session_cache, blocking_profile=blocking_profile
+        )
+        try:
+            pages = _visit_sites(session, capture, pipeline_depth)
+            for site, ad_images_bytes in pages:
+                results.put((
+                    'page', worker_id, site, email, age, gender,
+                    ad_images_bytes
+                ))
+
+        finally:
+            session.close()
+
+        results.put(('account_done', worker_id, email))
+    results.put(('worker_done', worker_id))
+
+
+def run_parallel(
+    workers=None, capture='crop', recycle_after=None, pipeline_depth=0,
+    blocking_profile=None
+):
+    """
+    Like `run`, but each account is handled by one of `workers` processes
+    (see `default_worker_count`), each with its own browser. Pages are
+    streamed back and written by this process's single `AdLoader`. Pages a
+    worker streamed before dying are kept, but the rest of the account it
+    was on is not retried, and its remaining accounts go to the others.
+    """
+    accounts = list(read_all_logins())
+    session_cache = SessionCache()
+    valid = session_cache.validate([account[0] for account in accounts])
+    print('Cached sessions still valid: {}/{}'.format(
+        len(valid), len(accounts)
+    ))
+
+    if workers is None:
+        workers = default_worker_count(len(accounts))
+    account_queue = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for account in accounts:
+        account_queue.put(account)
+    for _ in range(workers):
+        account_queue.put(None)
+
+    processes = {}
+    stats = {}
+    for worker_id in range(workers):
+        processes[worker_id] = multiprocessing.Process(
+            target=_account_worker,
+            args=(
+                worker_id, account_queue, results, capture, recycle_after,
+                pipeline_depth, blocking_profile
+            )
+        )
+        processes[worker_id].start()
+        stats[worker_id] = {
+            'pages': 0, 'ads': 0, 'start': time.monotonic(), 'end': None,
+            'account': None
+        }
+
+    def handle(message):
+        kind, worker_id = message[:2]
+        worker_stats = stats[worker_id]
+        if kind == 'page':
+            site, email, age, gender, ad_images_bytes = message[2:]
+            worker_stats['pages'] += 1
+            worker_stats['ads'] += len(ad_images_bytes)
             for ad_image_bytes in ad_images_bytes:
                 ad_loader.add_image_bytes(
                     ad_image_bytes, site, email, age, gender, []
                 )
+        elif kind == 'account_start':
+            worker_stats['account'] = message[2]
+        elif kind == 'account_done':
+            worker_stats['account'] = None
+        elif kind == 'worker_done':
+            running.discard(worker_id)
+            worker_stats['end'] = time.monotonic()
+
+    with AdLoader(index='final', bulk=True) as ad_loader:
+        running = set(processes)
+        while running:
+            try:
+                handle(results.get(timeout=RESULT_POLL_SECONDS))
+
+            except queue.Empty:
+                ad_loader.flush_if_due()
+                for worker_id in list(running):
+                    process = processes[worker_id]
+                    if process.is_alive():
+                        continue
+                    running.discard(worker_id)
+                    stats[worker_id]['end'] = time.monotonic()
+                    if process.exitcode:
+                        print(
+                            'Worker {} died (exit code {}) on account {}, '
+                            'its remaining sites are skipped'.format(
+                                worker_id, process.exitcode,
+                                stats[worker_id]['account']
+                            )
+                        )
+
+        # Messages an exited worker queued before the loop noticed it.
+        while True:
+            try:
+                handle(results.get_nowait())
+            except queue.Empty:
+                break
+
+        for process in processes.values():
+            process.join()
+
+    for worker_id in sorted(stats):
+        worker_stats = stats[worker_id]
+        end = worker_stats['end'] or time.monotonic()
+        elapsed = end - worker_stats['start']
+        print('Worker {}: {} pages, {} ads in {:.1f}s ({:.2f} pages/min)'
+              .format(
+                  worker_id, worker_stats['pages'], worker_stats['ads'],
+                  elapsed,
+                  60 * worker_stats['pages'] / elapsed if elapsed else 0.0
+              ))
+
+    print('Perceptual hash index:', ad_loader.phash_index.info())
+    print('Known IDs:', ad_loader.known_ids.info())
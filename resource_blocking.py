@@ -0,0 +1,113 @@
+from collections import namedtuple
+
+from ad_images import classify_urls
+
+# A class of resources the ads we capture never need: blocked by host
+# through DevTools and, only with `all_hosts`, by URL extension and by
+# Chrome switches that stop the browser from requesting them at all.
+ResourceClass = namedtuple(
+    'ResourceClass', ['extensions', 'hosts', 'chrome_arguments']
+)
+
+RESOURCE_CLASSES = {
+    'media': ResourceClass(
+        extensions=('mp4', 'webm', 'm3u8', 'm4s', 'mpd', 'mp3', 'ogg'),
+        hosts=('googlevideo.com',),
+        chrome_arguments=('--autoplay-policy=user-gesture-required',)
+    ),
+    'fonts': ResourceClass(
+        extensions=('woff', 'woff2', 'ttf', 'otf', 'eot'),
+        hosts=('fonts.gstatic.com', 'use.typekit.net'),
+        chrome_arguments=('--disable-remote-fonts',)
+    ),
+    'analytics': ResourceClass(
+        extensions=(),
+        hosts=(
+            'google-analytics.com', 'hotjar.com', 'scorecardresearch.com',
+            'quantserve.com', 'nr-data.net', 'segment.io', 'mixpanel.com',
+            'chartbeat.com'
+        ),
+        chrome_arguments=()
+    ),
+}
+
+
+class ResourceBlockingProfile(object):
+    """
+    Blocks the hosts of the `RESOURCE_CLASSES` named in `resource_classes`,
+    plus any extra `patterns` (DevTools wildcards, '*' only), with
+    `Network.setBlockedURLs`. Hosts that EasyList says serve ads are left
+    out (see `spared_hosts`).
+
+    With `all_hosts` the classes' extensions and Chrome switches are used
+    too. Those cannot be limited to non-ad hosts, so they also block ad
+    videos and the fonts of ad iframes; check `NetworkActivity.blocked`
+    with `blocked_ads`. The same goes for `patterns`.
+
+    Add `add_to_options` to the Chrome options before the browser starts
+    and call `apply` on every tab (DevTools target) it should cover.
+    """
+
+    def __init__(
+        self, resource_classes=tuple(RESOURCE_CLASSES), patterns=(),
+        all_hosts=False
+    ):
+        self.resource_classes = tuple(resource_classes)
+        self.extra_patterns = tuple(patterns)
+        self.all_hosts = all_hosts
+        self.spared_hosts = []
+        self._patterns = None
+
+    def add_to_options(self, options):
+        if not self.all_hosts:
+            return options
+        for name in self.resource_classes:
+            for argument in RESOURCE_CLASSES[name].chrome_arguments:
+                options.add_argument(argument)
+        return options
+
+    def patterns(self):
+        if self._patterns is not None:
+            return self._patterns
+
+        extensions = []
+        hosts = []
+        for name in self.resource_classes:
+            if self.all_hosts:
+                extensions.extend(RESOURCE_CLASSES[name].extensions)
+            hosts.extend(RESOURCE_CLASSES[name].hosts)
+
+        probes = ['https://{}/'.format(host) for host in hosts]
+        verdicts = classify_urls(probes)
+        patterns = []
+        for extension in extensions:
+            patterns.append('*.{}'.format(extension))
+            patterns.append('*.{}?*'.format(extension))
+        for host in hosts:
+            if verdicts['https://{}/'.format(host)]:
+                self.spared_hosts.append(host)
+                continue
+            patterns.append('*://{}/*'.format(host))
+            patterns.append('*.{}/*'.format(host))
+        patterns.extend(self.extra_patterns)
+        self._patterns = patterns
+        return patterns
+
+    def apply(self, driver):
+        """ Starts blocking in the driver's current tab """
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd(
+            'Network.setBlockedURLs', {'urls': self.patterns()}
+        )
+
+    @staticmethod
+    def remove(driver):
+        """ Stops blocking in the driver's current tab """
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': []})
+
+
+def blocked_ads(network):
+    """ The URLs blocked in a `NetworkActivity` that EasyList calls ads """
+    urls = [url for url in network.blocked if url]
+    verdicts = classify_urls(urls)
+    return [url for url in urls if verdicts[url]]
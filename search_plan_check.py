@@ -0,0 +1,278 @@
+"""
+Checks that Browser's element search, driven by element_search_plan, sends a
+driver the same queries in the same order as the hand-written cascade it
+replaced ( _legacy_search below ) , for every combination of search
+parameters and of which queries find something .
+
+    python search_plan_check.py
+"""
+
+import itertools
+import sys
+
+from crawler_utils import Browser
+
+TEXTS = ["", "Sign in", "Login", "email", "password"]
+TAGS = ["", "input", "button", "link", "div"]
+CLASSNAMES = ["", "nav"]
+IDS = ["", "login"]
+CSS_SELECTORS = ["", "form > input"]
+XPATHS = ["", "//form"]
+LOOSE_MATCHES = [False, True]
+
+# Which queries find an element; the others find nothing. They decide which
+# "only if nothing was found yet" fallbacks run.
+ANSWERS = {
+    "nothing": lambda by, query: False,
+    "everything": lambda by, query: True,
+    "labels": lambda by, query: "label" in query,
+    "inputs": lambda by, query: "input" in query,
+}
+
+
+class RecordingElement:
+    """An element that is visible, enabled and labels "field" ; the queries
+    run from it are recorded by its driver"""
+
+    def __init__(self, driver, id):
+        self.driver = driver
+        self.id = id
+        self.tag_name = "input"
+
+    def is_displayed(self):
+        return True
+
+    def is_enabled(self):
+        return True
+
+    def get_attribute(self, name):
+        return {"for": "field", "type": "text"}.get(name, "")
+
+    def find_elements_by_xpath(self, query):
+        return self.driver.find(self.id + " xpath", query)
+
+
+class RecordingDriver:
+    """Records every find_elements_by_* query ; answer( by , query ) says
+    whether it finds one new element"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.queries = []
+
+    def find(self, by, query):
+        self.queries.append((by, query))
+        if not self.answer(by, query):
+            return []
+        return [RecordingElement(self, "element{}".format(len(self.queries)))]
+
+    def find_elements_by_xpath(self, query):
+        return self.find("xpath", query)
+
+    def find_elements_by_link_text(self, query):
+        return self.find("link_text", query)
+
+    def find_elements_by_css_selector(self, query):
+        return self.find("css_selector", query)
+
+    def find_elements_by_id(self, query):
+        return self.find("id", query)
+
+    def find_elements_by_class_name(self, query):
+        return self.find("class_name", query)
+
+
+def _legacy_search(driver, text, tag, classname, id, css_selector, xpath, loose_match):
+    """The queries of Browser.__find_element before element_search_plan, with
+    the scoring left out ; returns the number of elements found"""
+
+    found = []
+    if tag == "link":
+        tag = "a"
+
+    def element_fetch_helper(xpath, score=None):
+        found.extend(driver.find_elements_by_xpath(xpath))
+
+    def find_input_element_for_label(elementlist, score=None):
+        for element in elementlist:
+            if not element.is_displayed:
+                continue
+
+            possible_input_id = element.get_attribute("for")
+            element_fetch_helper("//body//input[@id='{}']".format(possible_input_id))
+            found.extend(
+                element.find_elements_by_xpath(
+                    "../input[contains(translate(@id , '{}' ,'{}' ) , '{}')]".format(
+                        text.upper(), text.lower(), text.lower()
+                    )
+                )
+            )
+            found.extend(element.find_elements_by_xpath("/./preceding::input"))
+            element_fetch_helper("//body//input[@name='{}']".format(possible_input_id))
+            found.extend(element.find_elements_by_xpath("../input"))
+
+    def handle_input_tag():
+        if text:
+            for test_attr in ["@value", "@placeholder", "name", "@aria-label"]:
+                element_fetch_helper("//body//input[{}='{}']".format(test_attr, text))
+                element_fetch_helper(
+                    "//body//input[contains( {} , '{}')]".format(test_attr, text)
+                )
+                element_fetch_helper(
+                    "//body//input[contains(translate( {} , '{}' , '{}' ) , '{}')]".format(
+                        test_attr, text.upper(), text.lower(), text.lower()
+                    )
+                )
+
+            find_input_element_for_label(
+                driver.find_elements_by_xpath("//body//label[text()='{}']".format(text))
+            )
+            find_input_element_for_label(
+                driver.find_elements_by_xpath(
+                    "//body//label[contains( text() , '{}')]".format(text)
+                )
+            )
+            find_input_element_for_label(
+                driver.find_elements_by_xpath(
+                    "//body//label[contains(translate( text() , '{}' , '{}' ) , '{}')]".format(
+                        text.upper(), text.lower(), text.lower()
+                    )
+                )
+            )
+
+        else:
+            element_fetch_helper("//body//{}".format(tag))
+
+    def handle_button_or_link_tag(tagvar):
+        if text:
+            element_fetch_helper("//body//{}[text()='{}']".format(tagvar, text))
+            element_fetch_helper("//body//{}//*[text()='{}']".format(tagvar, text))
+            found.extend(driver.find_elements_by_link_text("{}".format(text)))
+            element_fetch_helper(
+                "//body//{}[contains(text() , '{}')]".format(tagvar, text)
+            )
+            element_fetch_helper(
+                "//body//{}//*[contains(text() , '{}')]".format(tagvar, text)
+            )
+            element_fetch_helper(
+                "//body//{}[contains(translate(text() , '{}' , '{}' ) , '{}')]".format(
+                    tagvar, text.upper(), text.lower(), text.lower()
+                )
+            )
+            element_fetch_helper(
+                "//body//{}//*[contains(translate(text() , '{}' , '{}' ) , '{}')]".format(
+                    tagvar, text.upper(), text.lower(), text.lower()
+                )
+            )
+
+        else:
+            element_fetch_helper("//body//{}".format(tagvar))
+
+    def handle_loose_check():
+        if text:
+            element_fetch_helper("//body//*[@value='{}']".format(text))
+            element_fetch_helper("//body//*[text()='{}']".format(text))
+            element_fetch_helper("//body//*[contains(text() , '{}')]".format(text))
+            element_fetch_helper(
+                "//body//*[contains(translate(text() , '{}' , '{}' ) , '{}' )]".format(
+                    text.upper(), text.lower(), text.lower()
+                )
+            )
+
+    if css_selector:
+        found.extend(driver.find_elements_by_css_selector(css_selector))
+
+    if xpath:
+        found.extend(driver.find_elements_by_xpath(xpath))
+
+    if not text and tag:
+        element_fetch_helper("//body//{}".format(tag))
+
+    elif tag:
+        element_fetch_helper("//body//{}[@value='{}']".format(tag, text))
+        element_fetch_helper("//body//{}[text()='{}']".format(tag, text))
+        element_fetch_helper("//body//{}[contains(text() , '{}') ]".format(tag, text))
+        element_fetch_helper(
+            "//body//{0}[contains(translate(text()  ,'{1}', '{2}') , '{2}') ]".format(
+                tag, text.upper(), text.lower()
+            )
+        )
+
+    if text.lower() in "your password":
+        element_fetch_helper(
+            "//body//input[contains(@name , '{}') ]".format("password")
+        )
+
+    if text.lower() in ["username", "email", "login"] and tag == "input":
+        element_fetch_helper(
+            """//body//input[contains(translate(@name , 'USERNAME' , 'username' )  , 'username') or contains(translate(@name ,'EMAIL' , 'email' ) , 'email') or contains(translate(@name , 'LOGIN' , 'login'  ) , 'login' ) or contains(translate(@type , 'EMAIL' , 'email') , 'email')] """
+        )
+
+    if tag == "input":
+        handle_input_tag()
+
+    if tag == "button":
+        handle_button_or_link_tag(tag)
+
+        if not found:
+            handle_input_tag()
+        if not found:
+            handle_button_or_link_tag("a")
+
+    if id:
+        found.extend(driver.find_elements_by_id(id))
+    if classname:
+        found.extend(driver.find_elements_by_class_name(classname))
+
+    if not found and loose_match:
+        handle_loose_check()
+
+    return len(found)
+
+
+def check_search_plan():
+    """Returns the parameter combinations whose queries differ from the
+    legacy cascade's , after printing how many were checked"""
+
+    browser = Browser.__new__(Browser)
+    browser.in_page_search = False
+    browser.locator_cache = None
+    browser._locator_cache_key = None
+
+    mismatches = []
+    combinations = list(
+        itertools.product(
+            TEXTS, TAGS, CLASSNAMES, IDS, CSS_SELECTORS, XPATHS, LOOSE_MATCHES,
+            sorted(ANSWERS),
+        )
+    )
+    for combination in combinations:
+        text, tag, classname, id, css_selector, xpath, loose_match, answer = combination
+
+        legacy_driver = RecordingDriver(ANSWERS[answer])
+        _legacy_search(
+            legacy_driver, text, tag, classname, id, css_selector, xpath, loose_match
+        )
+
+        browser.driver = RecordingDriver(ANSWERS[answer])
+        browser.errors = list()
+        browser._Browser__find_element(
+            text, tag, classname, id, 1, css_selector, xpath, loose_match
+        )
+
+        if browser.driver.queries != legacy_driver.queries:
+            mismatches.append(combination)
+
+    print(
+        "{} combinations checked, {} with different queries".format(
+            len(combinations), len(mismatches)
+        )
+    )
+    return mismatches
+
+
+if __name__ == "__main__":
+    mismatches = check_search_plan()
+    for mismatch in mismatches:
+        print("different queries:", mismatch)
+    sys.exit(1 if mismatches else 0)
@@ -20,13 +20,12 @@ import sqlite3
 import json
 from contextlib import contextmanager
 from tempfile import gettempdir
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.common.by import By
 from selenium.common.exceptions import NoSuchElementException
 from selenium.common.exceptions import WebDriverException
 from selenium.common.exceptions import TimeoutException
 
+from waits import WAIT_BUDGET, WaitBudget, document_element, explicit_wait
+
 
 def delete_line_from_file(filepath, userToDelete, logger):
     """ Remove user's record from the followed pool file after unfollowing """
@@ -109,7 +108,10 @@ def scroll_bottom(browser, element, range_int):
     return
 
 
-def click_element(browser, element, tryNum=0):
+def click_element(browser, element, tryNum=0, budget=None):
+    if budget is None:
+        budget = WaitBudget()
+
     try:
         # use Selenium's built in click function
         element.click()
@@ -155,14 +157,16 @@ def click_element(browser, element, tryNum=0):
         # update server calls after the scroll(s) in 0, 1 and 2 attempts
         update_activity(browser, state=None)
 
-        # sleep for 1 second to allow window to adjust (may or may not be
-        # needed)
-        sleep_actual(1)
+        # wait for the window to adjust until the element shows up
+        try:
+            explicit_wait(browser, "VOE", [element], notify=False, budget=budget)
+        except WebDriverException:
+            pass
 
         tryNum += 1
 
         # try again!
-        click_element(browser, element, tryNum)
+        click_element(browser, element, tryNum, budget)
 
 
 def format_number(number):
@@ -186,9 +190,10 @@ def format_number(number):
 
 
 
-def web_address_navigator(browser, link):
+def web_address_navigator(browser, link, timeout=WAIT_BUDGET):
     """Checks and compares current URL of web page and the URL to be
-    navigated and if it is different, it does navigate"""
+    navigated and if it is different, it does navigate and waits up to
+    timeout seconds for the page to load"""
     current_url = get_current_url(browser)
     total_timeouts = 0
     page_type = None  # file or directory
@@ -212,7 +217,9 @@ def web_address_navigator(browser, link):
                 browser.get(link)
                 # update server calls
                 update_activity(browser, state=None)
-                sleep(2)
+                explicit_wait(
+                    browser, "PFL", [], notify=False, budget=WaitBudget(timeout)
+                )
                 break
 
             except TimeoutException as exc:
@@ -295,87 +302,25 @@ def emergency_exit(browser, username, logger):
 
 
 @contextmanager
-def new_tab(browser):
+def new_tab(browser, timeout=WAIT_BUDGET):
     """ USE once a host tab must remain untouched and yet needs extra data-
     get from guest tab """
+    budget = WaitBudget(timeout)
+    windows = len(browser.window_handles)
     try:
         # add a guest tab
         browser.execute_script("window.open()")
-        sleep(1)
+        explicit_wait(browser, "NW", [windows + 1], notify=False, budget=budget)
         # switch to the guest tab
         browser.switch_to.window(browser.window_handles[1])
-        sleep(2)
         yield
 
     finally:
         # close the guest tab
         browser.execute_script("window.close()")
-        sleep(1)
+        explicit_wait(browser, "NW", [windows], notify=False, budget=budget)
         # return to the host tab
         browser.switch_to.window(browser.window_handles[0])
-        sleep(2)
-
-
-def explicit_wait(browser, track, ec_params, logger, timeout=35, notify=True):
-    """
-    Explicitly wait until expected condition validates
-
-    :param browser: webdriver instance
-    :param track: short name of the expected condition
-    :param ec_params: expected condition specific parameters - [param1, param2]
-    :param logger: the logger instance
-    """
-    if not isinstance(ec_params, list):
-        ec_params = [ec_params]
-
-    # find condition according to the tracks
-    if track == "VOEL":
-        elem_address, find_method = ec_params
-        ec_name = "visibility of element located"
-
-        find_by = (
-            By.XPATH
-            if find_method == "XPath"
-            else By.CSS_SELECTOR
-            if find_method == "CSS"
-            else By.CLASS_NAME
-        )
-        locator = (find_by, elem_address)
-        condition = ec.visibility_of_element_located(locator)
-
-    elif track == "TC":
-        expect_in_title = ec_params[0]
-        ec_name = "title contains '{}' string".format(expect_in_title)
-
-        condition = ec.title_contains(expect_in_title)
-
-    elif track == "PFL":
-        ec_name = "page fully loaded"
-        condition = lambda browser: browser.execute_script(
-            "return document.readyState"
-        ) in ["complete" or "loaded"]
-
-    elif track == "SO":
-        ec_name = "staleness of"
-        element = ec_params[0]
-
-        condition = ec.staleness_of(element)
-
-    # generic wait block
-    try:
-        wait = WebDriverWait(browser, timeout)
-        result = wait.until(condition)
-
-    except TimeoutException:
-        if notify is True:
-            logger.info(
-                "Timed out with failure while explicitly waiting until {}!\n".format(
-                    ec_name
-                )
-            )
-        return False
-
-    return result
 
 
 def get_current_url(browser):
@@ -444,11 +389,14 @@ def smart_run(session, threaded=False):
         session.end(threaded_session=threaded)
 
 
-def reload_webpage(browser):
-    """ Reload the current webpage """
+def reload_webpage(browser, timeout=WAIT_BUDGET):
+    """ Reload the current webpage and wait up to timeout seconds for it """
+    budget = WaitBudget(timeout)
+    old_document = document_element(browser)
     browser.execute_script("location.reload()")
     update_activity(browser, state=None)
-    sleep(2)
+    explicit_wait(browser, "NC", [old_document], notify=False, budget=budget)
+    explicit_wait(browser, "PFL", [], notify=False, budget=budget)
 
     return True
 
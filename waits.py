@@ -0,0 +1,185 @@
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as ec
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
+
+# Seconds that all the waits of one navigation, reload, tab switch or click
+# may take together.
+WAIT_BUDGET = 10
+# Seconds between two checks of a wait's condition.
+WAIT_POLL_FREQUENCY = 0.1
+
+# Upper bounds (seconds) of the `wait_latency` histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 35)
+
+
+class WaitLatencyHistogram(object):
+    """ How long each kind of `explicit_wait` took, per track """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._tracks = OrderedDict()
+
+    def record(self, track, seconds, timed_out=False):
+        stats = self._tracks.get(track)
+        if stats is None:
+            stats = self._tracks[track] = {
+                "count": 0,
+                "timeouts": 0,
+                "total": 0.0,
+                "buckets": [0] * (len(self.buckets) + 1),
+            }
+        stats["count"] += 1
+        stats["timeouts"] += timed_out
+        stats["total"] += seconds
+        stats["buckets"][bisect_left(self.buckets, seconds)] += 1
+
+    def summary(self):
+        """ track -> count, timeouts, mean seconds and {upper bound: count} """
+        bounds = [str(bound) for bound in self.buckets] + ["inf"]
+        return OrderedDict(
+            (
+                track,
+                {
+                    "count": stats["count"],
+                    "timeouts": stats["timeouts"],
+                    "mean": stats["total"] / stats["count"],
+                    "buckets": OrderedDict(zip(bounds, stats["buckets"])),
+                },
+            )
+            for track, stats in self._tracks.items()
+        )
+
+    def print_summary(self):
+        for track, stats in self.summary().items():
+            print(
+                "{:5}: {} waits, {} timeouts, {:.3f}s mean, {}".format(
+                    track,
+                    stats["count"],
+                    stats["timeouts"],
+                    stats["mean"],
+                    " ".join(
+                        "<={}:{}".format(bound, count)
+                        for bound, count in stats["buckets"].items()
+                        if count
+                    ),
+                )
+            )
+
+    def clear(self):
+        self._tracks.clear()
+
+
+wait_latency = WaitLatencyHistogram()
+
+
+class WaitBudget(object):
+    """ A deadline shared by the waits of one call """
+
+    def __init__(self, seconds=WAIT_BUDGET):
+        self.deadline = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+
+def document_element(browser):
+    """ The current document's root element; it goes stale once a
+    navigation commits, see the "NC" track of `explicit_wait` """
+    return browser.find_element_by_tag_name("html")
+
+
+def explicit_wait(
+    browser, track, ec_params, logger=None, timeout=35, notify=True, budget=None
+):
+    """
+    Explicitly wait until expected condition validates
+
+    :param browser: webdriver instance
+    :param track: short name of the expected condition
+    :param ec_params: expected condition specific parameters - [param1, param2]
+    :param logger: the logger instance, None to not log timeouts
+    :param budget: a WaitBudget that caps the timeout
+
+    Every wait is recorded per track in `wait_latency`.
+    """
+    if not isinstance(ec_params, list):
+        ec_params = [ec_params]
+
+    # find condition according to the tracks
+    if track == "VOEL":
+        elem_address, find_method = ec_params
+        ec_name = "visibility of element located"
+
+        find_by = (
+            By.XPATH
+            if find_method == "XPath"
+            else By.CSS_SELECTOR
+            if find_method == "CSS"
+            else By.CLASS_NAME
+        )
+        locator = (find_by, elem_address)
+        condition = ec.visibility_of_element_located(locator)
+
+    elif track == "VOE":
+        ec_name = "visibility of element"
+        element = ec_params[0]
+
+        condition = ec.visibility_of(element)
+
+    elif track == "TC":
+        expect_in_title = ec_params[0]
+        ec_name = "title contains '{}' string".format(expect_in_title)
+
+        condition = ec.title_contains(expect_in_title)
+
+    elif track == "PFL":
+        ec_name = "page fully loaded"
+        condition = lambda browser: browser.execute_script(
+            "return document.readyState"
+        ) in ["complete" or "loaded"]
+
+    elif track == "SO":
+        ec_name = "staleness of"
+        element = ec_params[0]
+
+        condition = ec.staleness_of(element)
+
+    elif track == "NC":
+        # ec_params: the `document_element` from before the navigation
+        ec_name = "navigation committed"
+        old_document = ec_params[0]
+
+        condition = ec.staleness_of(old_document)
+
+    elif track == "NW":
+        number_of_windows = ec_params[0]
+        ec_name = "number of windows to be {}".format(number_of_windows)
+
+        condition = ec.number_of_windows_to_be(number_of_windows)
+
+    if budget is not None:
+        timeout = min(timeout, budget.remaining())
+
+    # generic wait block
+    start = time.monotonic()
+    try:
+        wait = WebDriverWait(browser, timeout, WAIT_POLL_FREQUENCY)
+        result = wait.until(condition)
+
+    except TimeoutException:
+        wait_latency.record(track, time.monotonic() - start, timed_out=True)
+        if notify is True and logger is not None:
+            logger.info(
+                "Timed out with failure while explicitly waiting until {}!\n".format(
+                    ec_name
+                )
+            )
+        return False
+
+    wait_latency.record(track, time.monotonic() - start)
+    return result